@@ -1,68 +1,110 @@
+import asyncio
 from crypt import methods
+from datetime import datetime
+import functools
+import queue
+import time
+
+import click
 from flask import (Flask, g, render_template, flash, redirect,
-                    abort, url_for)
-from flask_bcrypt import generate_password_hash, check_password_hash
+                    abort, url_for, request, session, stream_with_context)
 from flask_login import (LoginManager, login_user, logout_user,
                          login_required, current_user)
+from markupsafe import Markup
 
 import forms
+import fragments
+import graph
+import instrumentation
+import live
 import models 
+import passwords
+import writes
 
 DEBUG = True 
 PORT = 8000
 HOST = '0.0.0.0'
 
 
-app = Flask(__name__)
+class SocialApp(Flask):
+    def async_to_sync(self, func):
+        """Run an async view on the request's own thread, in an event loop of its own.
+
+        Flask's default (asgiref) runs it on another thread, or under asgi.py on
+        the server's event loop, while the request thread sits waiting for it
+        anyway; that's an extra thread hop per request for nothing.
+        """
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            return asyncio.run(func(*args, **kwargs))
+        return run
+
+
+app = SocialApp(__name__)
 app.secret_key = 'asasd;lkajsdfl;kj'
 
+instrumentation.init_app(app) # query counts and timings per request
+
+if models.SQLITE_PROFILE != 'default':
+    models.start_maintenance() # WAL checkpoints and optimize in the background, whether run here, by flask run or by asgi.py
+
 login_manager = LoginManager()
 login_manager.init_app(app) # sets up login manager for application, paying attention to our view, controlling our user, getting our global object
 login_manager.login_view = 'login' # if not logged in, redirect to someone for user to login
 
+def get_user(user_id):
+    """The one User instance for `user_id` in this request, loaded through the user cache."""
+    user_id = int(user_id)
+    if user_id not in g.users:
+        g.users[user_id] = models.USER_CACHE.get(user_id)
+    return g.users[user_id]
+
 @login_manager.user_loader
 def load_user(userid):
     try:
-        return models.User.get(models.User.id == userid)
-    except models.DoesNotExist: # doesnotexist is something that comes from peewee
+        return get_user(userid)
+    except (models.DoesNotExist, ValueError): # doesnotexist is something that comes from peewee
         return None
 
 @app.before_request
 def before_request():
-    """Connect to the database before each request."""
+    """Set up request globals; the database connects by itself on the first query."""
     g.db = models.DATABASE
-    g.db.connect()
+    g.users = {} # identity map for this request, user id -> User; see get_user()
     g.user = current_user
+    current_user.is_authenticated # load the user now, on the request thread, rather than inside an async view
+    if not models.DATABASE.is_closed():
+        models.DATABASE.close() # async views query from the database threads; don't sit on a pooled connection meanwhile
 
-@app.after_request
-def after_request(response):
-    """Close the database connection after each request."""
-    g.db.close()
-    return response
+@app.teardown_request
+def teardown_request(exception):
+    """Hand the database connection back to the pool, even if the request blew up."""
+    if not models.DATABASE.is_closed(): # requests that never queried (static files) never connected
+        models.DATABASE.close()
 
 @app.route('/register', methods=('GET', 'POST'))
-def register():
+async def register():
     form = forms.RegisterForm()
-    if form.validate_on_submit():
+    if await models.run_in_db(form.validate_on_submit): # validating checks the username and email are free
         flash('Yay, you registered!', 'success')
-        models.User.create_user(
+        await models.User.acreate_user(
             username=form.username.data,
             email=form.email.data,
             password=form.password.data
-        )
+        ) # hashed on the password pool without holding up the event loop
         return redirect(url_for('index'))
     return render_template('register.html', form=form)
 
 @app.route('/login', methods=('GET', 'POST'))
-def login():
+async def login():
     form = forms.LoginForm()
     if form.validate_on_submit():
         try:
-            user = models.User.get(models.User.email == form.email.data)
+            user = await models.User.aget(models.User.email == form.email.data)
         except models.DoesNotExist:
             flash('Your email or password doesn\'t match!', 'error')
         else:
-            if check_password_hash(user.password, form.password.data):
+            if await passwords.acheck_password(user.password, form.password.data):
                 login_user(user)
                 flash('You\'ve been logged in!', 'success')
                 return redirect(url_for('index'))
@@ -82,53 +124,165 @@ def logout():
 def post():
     form = forms.PostForm()
     if form.validate_on_submit():
-        models.Post.create(user=g.user._get_current_object(),
-                        content=form.content.data.strip())
+        writes.perform(models.Post.create, user=g.user._get_current_object(),
+                       content=form.content.data.strip()) #goes through the writer thread when WRITE_MODE is 'queue'
         flash('Message posted! Thanks!', 'success')
         return redirect(url_for('index'))
     return render_template('post.html', form=form)
 
+def paginate(query):
+    """Get the page of a post query asked for by the ?after=/?before= cursors."""
+    try:
+        return models.paginate(query,
+                               after=request.args.get('after'), # older posts
+                               before=request.args.get('before')) # newer posts
+    except ValueError: # somebody handed us a cursor we didn't make
+        abort(404)
+
+async def apaginate(query):
+    """paginate() for async views."""
+    return await models.run_in_db(paginate, query)
+
+app.jinja_env.globals['fragment_cache'] = fragments.cache # hit/miss counts for the debug panel
+
+@app.template_global()
+def render_post(post):
+    """A post's <article>, rendered once and then served from the fragment cache."""
+    key = f'post:{post.id}:{post.user.username}' # a new username means new HTML
+    return Markup(fragments.cache.get_or_render(
+        'article', key, fragments.ARTICLE_TTL,
+        lambda: render_template('_post.html', post=post)))
+
+async def render_index():
+    stream, older, newer = await apaginate(models.Post.with_authors())
+    return render_template('stream.html', stream=stream, older=older, newer=newer,
+                           events=url_for('index_events'))
+
 @app.route('/')
-def index():
-    stream = models.Post.select().limit(100) #check peewee docs for pagination
-    return render_template('stream.html', stream=stream)
+async def index():
+    if current_user.is_authenticated or session.get('_flashes'): # pages with something personal on them
+        return await render_index()
+    if app.debug: # the debug panel lists this request's queries, so the page can't be shared
+        return await render_index()
+    key = f'page:index:{fragments.cache.generation()}:{request.query_string.decode()}'
+    return await fragments.cache.aget_or_render('page', key, fragments.PAGE_TTL, render_index) # everyone logged out sees the same page
 
 @app.route('/stream')
 @app.route('/stream/<username>')
-def stream(username=None):
+async def stream(username=None):
     template = 'stream.html' #default is w/o username, you will see your stream and posts of you and people you follow 
     if username and username != current_user.username: #if there is a user name you get that user's posts
         try:
-            user = models.User.select().where(
-                models.User.username**username).get() #the ** represents is 'LIKE' username, comparison that is not case sensitive
+            user = await models.run_in_db(models.User.by_username, username) #comparison that is not case sensitive
+            user = g.users.setdefault(user.id, user) #reuse the instance if this request already has one
         except models.DoesNotExist:
             abort(404) #if user doesn't exist
         else:
-            stream = user.posts.limit(100)
+            stream = user.get_posts()
+            events = url_for('user_events', username=user.username)
     else: #in other words it's us that is logged in
         user = current_user
-        stream = current_user.get_stream().limit(100)
+        stream = current_user.get_stream()
+        events = url_for('stream_events')
+    context = {}
     if username:
         template = 'user_stream.html'
-    return render_template(template, user=user, stream=stream)
+        context['stats'] = await models.run_in_db(lambda: user.stats) # the profile header's counts
+        if current_user.is_authenticated and user != current_user:
+            context['is_following'] = await models.run_in_db(current_user.is_following, user) # for the follow button
+    stream, older, newer = await apaginate(stream)
+    return render_template(template, user=user, stream=stream, # rendered here; only the queries go to the database threads
+                           older=older, newer=newer, events=events, **context)
 
 @app.route('/post/<int:post_id>')
-def view_post(post_id):
-    posts = models.Post.select().where(models.Post.id == post_id) #interesting, I didn't create a specific id, looks like this is included
-    if posts.count() == 0:
+async def view_post(post_id):
+    try:
+        post = await models.Post.with_authors().where(models.Post.id == post_id).aget() #interesting, I didn't create a specific id, looks like this is included
+    except models.DoesNotExist:
+        abort(404)
+    return render_template('stream.html', stream=[post])
+
+def release_connection():
+    """Give this thread's pooled connection back, if it has one open."""
+    if not models.DATABASE.is_closed() and not models.DATABASE.in_transaction():
+        models.DATABASE.close()
+
+def post_events(query, authors=None):
+    """A Server-Sent Events response with the posts from `query` newer than the client's last one.
+
+    First whatever the client missed, from one `id > since_id` query (the
+    browser sends Last-Event-ID when it reconnects), then each new post as
+    live.hub publishes it. `authors` are the user ids `query` is limited to.
+    """
+    since_id = request.headers.get('Last-Event-ID') or request.args.get('since_id')
+    if since_id is not None and not since_id.isdigit():
+        abort(404)
+
+    def events():
+        subscription = live.hub.subscribe(authors) # before catching up, so nothing posted meanwhile slips past
+        try:
+            missed = []
+            if since_id is not None:
+                missed = list(query.where(models.Post.id > int(since_id))
+                              .order_by(models.Post.id).limit(models.PAGE_SIZE + 1))
+            release_connection() # whatever the view queried, an open stream mustn't keep a pooled connection
+            yield f'retry: {live.RETRY_MS}\n\n'
+            if len(missed) > models.PAGE_SIZE: # too far behind to patch up; the page reloads instead
+                yield live.format_event('', event='reload')
+                return
+            sent = set()
+            for post in missed:
+                sent.add(post.id)
+                yield live.format_event(render_post(post), event='post', id=post.id)
+            release_connection() # rendering can query, e.g. a post's author
+            closes_at = time.monotonic() + live.STREAM_MAX_AGE
+            while time.monotonic() < closes_at and not subscription.overflowed:
+                try:
+                    post = subscription.posts.get(timeout=live.KEEPALIVE)
+                except queue.Empty:
+                    yield ': keepalive\n\n' # an SSE comment; also how we notice the client has gone
+                    continue
+                if post.id not in sent:
+                    event = live.format_event(render_post(post), event='post', id=post.id)
+                    release_connection()
+                    yield event
+        finally:
+            live.hub.unsubscribe(subscription)
+
+    return app.response_class(stream_with_context(events()), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/events')
+def index_events():
+    return post_events(models.Post.with_authors())
+
+@app.route('/events/stream')
+@login_required
+def stream_events():
+    user = current_user._get_current_object()
+    authors = {followed.id for followed in user.following().select(models.User.id)} | {user.id} # fixed until the next reconnect
+    return post_events(models.Post.with_authors().where(models.Post.user << authors), authors)
+
+@app.route('/events/stream/<username>')
+def user_events(username):
+    try:
+        user = models.User.by_username(username)
+    except models.DoesNotExist:
         abort(404)
-    return render_template('stream.html', stream=posts)
+    return post_events(models.Post.with_authors().where(models.Post.user == user), {user.id})
 
 @app.route('/follow/<username>')
 @login_required
-def follow(username):
+async def follow(username):
     try: #find the user
-        to_user = models.User.get(models.User.username**username) #try and grab username LIKE username passed in, store record in to_user... like is case insensitive
+        to_user = await models.run_in_db(models.User.by_username, username) #try and grab the user with that username, store record in to_user... the lookup is case insensitive
     except models.DoesNotExist: #if that user doesn't exist, do something
-        pass
+        abort(404)
     else: #otherwise the user does exist
+        if await models.run_in_db(g.user.is_following, to_user): #already following, no need to try the insert
+            abort(404)
         try: #therefore we create a record in Relationships
-            models.Relationship.create( #create a relationship
+            await writes.aperform(models.Relationship.create, #create a relationship
                 from_user=g.user._get_current_object(), #current user is me
                 to_user=to_user #to user is the user I want to follow
             )
@@ -142,25 +296,93 @@ def follow(username):
 @login_required
 def unfollow(username):
     try: #find the user
-        to_user = models.User.get(models.User.username**username) #try and grab username LIKE username passed in, store record in to_user... like is case insensitive
+        to_user = models.User.by_username(username) #try and grab the user with that username, store record in to_user... the lookup is case insensitive
     except models.DoesNotExist: #if that user doesn't exist, do something
-        pass
+        abort(404)
     else: #otherwise the user does exist
         try: #therefore we create a record in Relationships
-            models.Relationship.get( #get a specific relationship instead of creating one like in follow
-                from_user=g.user._get_current_object(), #current user is me
-                to_user=to_user 
-            ).delete() #delte this relationship from Relationship table
-        except models.IntegrityError: #this occurs b/c unique constraint; e.g. if we are creating a user that already exists
+            from_user = g.user._get_current_object() #current user is me
+            writes.perform(lambda: models.Relationship.get( #get a specific relationship instead of creating one like in follow
+                from_user=from_user,
+                to_user=to_user
+            ).delete_instance()) #delete this relationship from Relationship table
+        except (models.IntegrityError, models.DoesNotExist): #this occurs b/c unique constraint; e.g. if we are creating a user that already exists
             abort(404)
         else:
             flash(f'You\'ve unfollowed {to_user.username}!', 'success')
     return redirect(url_for('stream', username=to_user.username))
 
+@app.cli.command('rebuild-stats')
+def rebuild_stats():
+    """Recount every user's cached post/follower/following counts."""
+    models.rebuild_stats()
+    print('User stats rebuilt.')
+
+@app.cli.command('graph-snapshot')
+def graph_snapshot():
+    """Load the follow graph from the database and write the snapshot workers map at startup."""
+    with models.DATABASE.connection_context():
+        follows = graph.Graph.from_database()
+    follows.save()
+    print(f'Wrote {len(follows)} follows to {graph.GRAPH_SNAPSHOT}.')
+
+def route_queries(user):
+    """The queries behind each route, as (route, query) pairs, for check-indexes to explain."""
+    cursor = models.encode_cursor(models.Post(timestamp=datetime.now(), id=0)) # plans for page 2+, not just page 1
+    Relationship = models.Relationship
+    following = Relationship.select().where(
+        (Relationship.from_user == user) & (Relationship.to_user == user))
+    lookup = models.User.select().where(models.User.username.collate('NOCASE') == user.username)
+    queries = [('/', query) for query in models.page_queries(models.Post.with_authors(), after=cursor)]
+    queries += [('/stream', query) for query in models.page_queries(user.get_stream(), after=cursor)]
+    queries += [('/stream/<username>', query) for query in (
+        [lookup, models.UserStats.select().where(models.UserStats.user == user), following] +
+        models.page_queries(user.get_posts(), after=cursor))]
+    queries += [
+        ('/post/<id>', models.Post.with_authors().where(models.Post.id == 1)),
+        ('/follow/<username>', lookup),
+        ('/follow/<username>', following),
+        ('/unfollow/<username>', following),
+    ]
+    return queries
+
+@app.cli.command('check-indexes')
+@click.option('--build', is_flag=True, help='Create the missing indexes as well.')
+def check_indexes(build):
+    """Report missing indexes and how SQLite plans each route's queries."""
+    with models.DATABASE.connection_context():
+        for model in models.MODELS:
+            if not model.table_exists():
+                print(f'Missing table: {model._meta.table_name} (run models.initialize())')
+        for model, index in models.missing_indexes():
+            print(f'Missing index: {index._name}')
+        if build:
+            for name in models.build_indexes():
+                print(f'Built index: {name}')
+        user = models.User.select().first()
+        if user is None:
+            print('No users yet, so there are no query plans to show.')
+            return
+        for route, query in route_queries(user):
+            sql, params = query.sql()
+            print(f'\n{route}\n  {sql}')
+            try:
+                plan = models.DATABASE.execute_sql('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+            except models.OperationalError as exc: # e.g. a table that hasn't been created yet
+                print(f'    {exc}')
+                continue
+            for row in plan:
+                print(f'    {row[-1]}') # the last column is the plan step's description
+
 @app.errorhandler(404)
 def not_found(error):
     return render_template('404.html'), 404 #sends back status code 404 to render
 
+@app.errorhandler(passwords.PoolBusy)
+@app.errorhandler(writes.QueueFull)
+def too_busy(error):
+    return render_template('503.html'), 503, {'Retry-After': '5'} #too many logins or writes at once, ask the browser to come back shortly
+
 if __name__ == '__main__':
     models.initialize()
     try:        
@@ -172,6 +394,5 @@ if __name__ == '__main__':
         ) 
     except ValueError:
         pass
-
     app.run(debug=DEBUG, host=HOST, port=PORT)
     
\ No newline at end of file
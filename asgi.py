@@ -0,0 +1,165 @@
+"""Serve the app from an ASGI server, e.g. `uvicorn asgi:application`.
+
+The server keeps every connection on its event loop, so a slow client only
+costs a socket, not a thread. Each request then runs the Flask app on one of
+APP_WORKERS threads. The async views (index, stream, view_post, follow, login,
+register) await their queries on models.DB_WORKERS database threads, so under
+load requests queue for the database instead of each grabbing a thread and a
+pooled connection.
+
+/events streams (see live.py) sit idle most of the time, so they get their
+own, bigger pool of EVENT_WORKERS threads and can't crowd out page requests.
+
+The WSGI to ASGI bridge is written out below rather than taken from asgiref,
+whose adapter runs every request on one shared thread unless you reach into
+its internals.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+from tempfile import SpooledTemporaryFile
+import threading
+
+from app import app
+import models
+
+APP_WORKERS = int(os.environ.get('APP_WORKERS', 32)) # threads running Flask requests at once
+EVENT_WORKERS = int(os.environ.get('EVENT_WORKERS', 1000)) # open /events streams, each waiting on a thread
+BODY_IN_MEMORY = 64 * 1024 # request bodies bigger than this are spooled to a temp file
+
+models.OFFLOAD_QUERIES = True # async views queue for models.DB_WORKERS threads to run their queries
+
+_app_executor = ThreadPoolExecutor(max_workers=APP_WORKERS, thread_name_prefix='app')
+_event_executor = ThreadPoolExecutor(max_workers=EVENT_WORKERS, thread_name_prefix='events')
+
+
+def build_environ(scope, body):
+    """The WSGI environ for an ASGI http scope."""
+    script_name = scope.get('root_path', '').encode('utf8').decode('latin1') # WSGI strings are bytes as latin1
+    path_info = scope['path'].encode('utf8').decode('latin1')
+    if path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope["http_version"]}',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        if name not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
+            name = f'HTTP_{name}'
+        value = value.decode('latin1')
+        environ[name] = f'{environ[name]},{value}' if name in environ else value # repeated headers are joined
+    return environ
+
+
+class ClientGone(Exception):
+    """The client disconnected, so nothing more of its response should be produced."""
+
+
+async def watch_for_disconnect(receive, disconnected):
+    """Set `disconnected` once the server says the client has gone.
+
+    Servers don't make send() fail after a disconnect (uvicorn just drops
+    the message), so without this an /events stream would keep its thread
+    and its hub subscription until STREAM_MAX_AGE.
+    """
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+    disconnected.set()
+
+
+def run_wsgi(wsgi_app, environ, send, loop, disconnected):
+    """Call the WSGI app on this (worker) thread and hand its response to `send` on the event loop.
+
+    Stops at the next chunk once `disconnected` is set, closing the app's
+    response so a streaming generator runs its cleanup.
+    """
+    def send_now(message):
+        if disconnected.is_set():
+            raise ClientGone()
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    start = {}
+    def start_response(status, headers, exc_info=None):
+        if exc_info and start.get('sent'):
+            raise exc_info[1].with_traceback(exc_info[2]) # too late to change the status
+        start['message'] = {
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers],
+        }
+
+    def send_start():
+        if not start.get('sent'):
+            start['sent'] = True
+            send_now(start['message'])
+
+    response = wsgi_app(environ, start_response)
+    try:
+        for chunk in response:
+            send_start() # only once the app has produced something, so errors can still change the status
+            if chunk:
+                send_now({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        send_start()
+        send_now({'type': 'http.response.body'})
+    except ClientGone: # nobody to send the rest to
+        pass
+    finally:
+        if hasattr(response, 'close'): # ends streaming generators, e.g. an /events stream whose client left
+            response.close()
+
+
+class Application:
+    """The Flask app as an ASGI application, each request run on a worker thread."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan': # nothing to set up or tear down, just say so
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            raise ValueError(f'Unsupported ASGI scope: {scope["type"]}')
+        with SpooledTemporaryFile(max_size=BODY_IN_MEMORY) as body:
+            while True: # read the whole request body before the app sees it, as WSGI expects
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            executor = _event_executor if scope['path'].startswith('/events') else _app_executor
+            loop = asyncio.get_running_loop()
+            disconnected = threading.Event()
+            watcher = asyncio.ensure_future(watch_for_disconnect(receive, disconnected))
+            try:
+                await loop.run_in_executor(executor, run_wsgi, self.wsgi_app, build_environ(scope, body),
+                                           send, loop, disconnected)
+            finally:
+                watcher.cancel() # the response is done, whether or not the client stayed
+
+
+application = Application(app)
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""Benchmarks for the social app's routes.
+
+Seeds a throwaway social.db with synthetic users, a power-law follow graph
+and posts, then hammers the routes and reports p50/p95/p99 latency and
+throughput. Results are saved as JSON so runs on different commits can be
+compared:
+
+    python benchmark.py --output before.json
+    python benchmark.py --server --concurrency 16 --output after.json
+    python benchmark.py --compare before.json after.json
+    python benchmark.py --asgi --concurrency 1000 --output asgi.json
+
+The /follow and /new_post rows are writes, so their throughput is writes per
+second; run once with --write-mode direct and once with --write-mode queue
+to compare per-request commits against the group-commit writer.
+
+--mix runs routes at the same time, e.g. readers and writers together to
+compare --sqlite-profile default and performance:
+
+    python benchmark.py --server --concurrency 16 --routes / --mix / /new_post
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import http.cookiejar
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from werkzeug import serving
+from werkzeug.serving import make_server
+
+PASSWORD = 'benchmark'
+
+
+def seed(users, posts, follows, alpha, rng):
+    """Fill the (empty) database with users, follows and posts.
+
+    Who gets followed is drawn from a Zipf-like distribution, so a few users
+    have huge follower counts and most have a handful, like a real network.
+    """
+    import models
+    from passwords import hash_password
+
+    models.initialize()
+    password = hash_password(PASSWORD) # one hash shared by everyone, or seeding would take forever
+    start = datetime.now() - timedelta(days=365)
+    with models.DATABASE.atomic():
+        for batch in models.chunked(range(users), 100):
+            models.User.insert_many(
+                [(f'user{i}', f'user{i}@example.com', password, start) for i in batch],
+                fields=[models.User.username, models.User.email, models.User.password, models.User.joined_at]
+            ).execute()
+        user_ids = [user.id for user in models.User.select(models.User.id).order_by(models.User.id)]
+        weights = [1 / (rank + 1) ** alpha for rank in range(len(user_ids))] # user_ids[0] is the most popular
+
+        edges = set()
+        for follower in user_ids:
+            for followed in rng.choices(user_ids, weights, k=follows):
+                if followed != follower:
+                    edges.add((follower, followed))
+        for batch in models.chunked(sorted(edges), 400):
+            models.Relationship.insert_many(
+                batch, fields=[models.Relationship.from_user, models.Relationship.to_user]).execute()
+
+        post_seconds = 365 * 24 * 3600 / max(posts, 1)
+        for batch in models.chunked(range(posts), 300):
+            models.Post.insert_many(
+                [(rng.choice(user_ids), f'Benchmark post {i}', start + timedelta(seconds=i * post_seconds))
+                 for i in batch],
+                fields=[models.Post.user, models.Post.content, models.Post.timestamp]
+            ).execute()
+    models.rebuild_stats() # bulk inserts skip the counters
+    if models.TIMELINE_STRATEGY == 'fanout':
+        models.rebuild_timelines()
+    models.DATABASE.close()
+    return user_ids
+
+
+class TestClientSession:
+    """Sends requests through Flask's test client, without any networking."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        return self.client.open(path, method=method, data=data).status_code
+
+
+class HTTPSession:
+    """Sends requests to a real server over HTTP, keeping its session cookie."""
+
+    class NoRedirects(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None # report the 302 itself, like the test client does
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self.NoRedirects)
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data else None
+        request = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+        except (urllib.error.URLError, ConnectionError): # refused or dropped, e.g. the listen backlog overflowed
+            return 0
+
+
+def scenarios(user_ids, post_ids, rng, page_depth):
+    """(name, method, path maker, form data) for each route we measure."""
+    import models
+
+    deep = models.Post.get_by_id(post_ids[min(len(post_ids), models.PAGE_SIZE * (page_depth - 1)) - 1])
+    deep_cursor = models.encode_cursor(deep) # the last post before page `page_depth` of /, to show keyset paging doesn't slow down
+    username = lambda: f'user{rng.randrange(len(user_ids))}' # seed() numbers users in id order
+    return [
+        ('/', 'GET', lambda: '/', None),
+        ('/ (deep page)', 'GET', lambda: f'/?after={deep_cursor}', None),
+        ('/stream', 'GET', lambda: '/stream', None),
+        ('/stream (deep page)', 'GET', lambda: f'/stream?after={deep_cursor}', None), # the same point in time, in each reader's own stream
+        ('/stream/<username>', 'GET', lambda: f'/stream/{username()}', None),
+        ('/post/<id>', 'GET', lambda: f'/post/{rng.choice(post_ids)}', None),
+        ('/follow/<username>', 'GET', lambda: f'/follow/{username()}', None),
+        ('/new_post', 'POST', lambda: '/new_post', {'content': 'Benchmark write'}),
+        ('/login', 'POST', lambda: '/login', 'login'),
+    ]
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def run(groups, requests, idle_threads):
+    """Run each (scenario, sessions) group at the same time, spreading `requests` requests per
+    scenario over its sessions, one thread each. Returns a result per scenario name.
+
+    idle_threads is how many threads this process had before the server started;
+    each result's server_threads is the most the server had running on top of that.
+    """
+    lock = threading.Lock()
+    measured = {scenario[0]: {'latencies': [], 'errors': 0, 'rejected': 0, 'finished': None}
+                for scenario, sessions in groups}
+    peak_threads = 0
+    running = True
+
+    def count_threads():
+        nonlocal peak_threads
+        while running:
+            threads = sum(not thread.name.startswith('client') for thread in threading.enumerate())
+            peak_threads = max(peak_threads, threads - idle_threads)
+            time.sleep(0.01)
+
+    def worker(scenario, session, login, count):
+        name, method, make_path, data = scenario
+        result = measured[name]
+        for _ in range(count):
+            form = login if data == 'login' else data
+            started = time.perf_counter()
+            status = session.request(method, make_path(), form)
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                result['latencies'].append(elapsed)
+                result['rejected'] += status == 503 # the password pool shedding load, see passwords.py
+                result['errors'] += status == 0 or (status >= 500 and status != 503)
+                result['finished'] = time.perf_counter()
+
+    counter = threading.Thread(target=count_threads, daemon=True)
+    counter.start()
+    started = time.perf_counter()
+    workers = sum(len(sessions) for scenario, sessions in groups)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='client') as pool:
+        for scenario, sessions in groups:
+            per_session = max(requests // len(sessions), 1)
+            for session, login in sessions:
+                pool.submit(worker, scenario, session, login, per_session)
+    running = False
+    counter.join()
+    results = {}
+    for name, result in measured.items():
+        latencies = sorted(result['latencies'])
+        wall = (result['finished'] or started) - started # until this scenario's last request, not the slowest one's
+        results[name] = {
+            'requests': len(latencies),
+            'errors': result['errors'],
+            'rejected': result['rejected'],
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'throughput_rps': len(latencies) / wall if wall else None,
+            'server_threads': peak_threads,
+        }
+    return results
+
+def print_result(name, result):
+    print(f'{name:22} p50 {result["p50_ms"]:7.2f}ms  p95 {result["p95_ms"]:7.2f}ms  '
+          f'p99 {result["p99_ms"]:7.2f}ms  {result["throughput_rps"]:8.1f} req/s  '
+          f'{result["errors"]} errors, {result["rejected"]} rejected, {result["server_threads"]} server threads')
+
+def start_asgi_server():
+    """Run asgi.application under uvicorn on a free port, in a background thread."""
+    import uvicorn
+    import asgi
+
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(asgi.application, host='127.0.0.1', port=port, log_level='error',
+                                           backlog=4096, timeout_keep_alive=1))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def benchmark(args):
+    rng = random.Random(args.seed)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='social-bench-')
+    os.chdir(workdir) # models.DATABASE opens 'social.db' relative to here, so the real one is never touched
+    if os.path.exists('social.db'):
+        raise SystemExit(f'{workdir} already has a social.db; give an empty --workdir')
+
+    os.environ['SQLITE_PROFILE'] = args.sqlite_profile # read when models is imported, just below
+    import app as social
+    import models
+    import writes
+    writes.WRITE_MODE = args.write_mode
+    social.app.config.update(WTF_CSRF_ENABLED=False, TESTING=False)
+
+    print(f'Seeding {args.users} users, {args.posts} posts in {workdir}...')
+    started = time.perf_counter()
+    user_ids = seed(args.users, args.posts, args.follows, args.alpha, rng)
+    with models.DATABASE.connection_context():
+        post_ids = [post.id for post in models.Post.select(models.Post.id)
+                    .order_by(models.Post.timestamp.desc(), models.Post.id.desc())]
+    print(f'Seeded in {time.perf_counter() - started:.1f}s.')
+    if models.PAGE_SIZE * (args.page_depth - 1) > len(post_ids):
+        print(f'Only {len(post_ids)} posts, so the deep page is the last page of /, not page {args.page_depth}.')
+
+    server = None
+    idle_threads = threading.active_count() + 1 # +1 for run()'s thread counter
+    logging.getLogger('werkzeug').setLevel(logging.ERROR) # no access log line per request
+    if args.asgi:
+        server = start_asgi_server()
+        make_session = lambda: HTTPSession(f'http://127.0.0.1:{server.config.port}')
+    elif args.server:
+        serving.ThreadedWSGIServer.request_queue_size = max(args.concurrency, 128) # listen backlog; werkzeug's 128 would refuse a 1k burst
+        server = make_server('127.0.0.1', 0, social.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        make_session = lambda: HTTPSession(f'http://127.0.0.1:{server.server_port}')
+    else:
+        make_session = lambda: TestClientSession(social.app)
+
+    sessions = []
+    for _ in range(args.concurrency):
+        session = make_session()
+        login = {'email': f'user{rng.randrange(len(user_ids))}@example.com', 'password': PASSWORD}
+        session.request('POST', '/login', login) # every session browses as a logged in user
+        sessions.append((session, login))
+
+    results = {}
+    try:
+        routes = scenarios(user_ids, post_ids, rng, args.page_depth)
+        for scenario in routes:
+            if (args.routes or args.mix) and scenario[0] not in (args.routes or []):
+                continue
+            results[scenario[0]] = result = run([(scenario, sessions)], args.requests, idle_threads)[scenario[0]]
+            print_result(scenario[0], result)
+        if args.mix:
+            mixed = [scenario for scenario in routes if scenario[0] in args.mix]
+            groups = [(scenario, sessions[number::len(mixed)]) for number, scenario in enumerate(mixed)] # clients split between the routes
+            print(f'Together ({", ".join(args.mix)}), {args.concurrency // len(mixed)} clients each:')
+            for name, result in run(groups, args.requests, idle_threads).items():
+                results[f'{name} (mixed)'] = result
+                print_result(f'{name} (mixed)', result)
+    finally:
+        if args.asgi:
+            server.should_exit = True
+        elif server:
+            server.shutdown()
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'mode': 'asgi' if args.asgi else 'server' if args.server else 'test_client',
+        'config': {
+            'users': args.users, 'posts': args.posts, 'follows': args.follows, 'alpha': args.alpha,
+            'page_depth': args.page_depth, 'requests': args.requests, 'concurrency': args.concurrency, 'seed': args.seed,
+            'timeline_strategy': models.TIMELINE_STRATEGY, 'sqlite_profile': models.SQLITE_PROFILE,
+            'write_mode': writes.WRITE_MODE, 'mix': args.mix,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f'Results written to {args.output}')
+    return report
+
+def compare(old_path, new_path):
+    """Print how each route's latency and throughput moved between two result files."""
+    with open(old_path) as file:
+        old = json.load(file)
+    with open(new_path) as file:
+        new = json.load(file)
+    print(f'{old.get("commit")} -> {new.get("commit")}')
+    for name, after in new['results'].items():
+        before = old['results'].get(name)
+        if not before:
+            print(f'{name:22} (new)')
+            continue
+        change = lambda key: (after[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+        print(f'{name:22} p50 {change("p50_ms"):+6.1f}%  p99 {change("p99_ms"):+6.1f}%  '
+              f'throughput {change("throughput_rps"):+6.1f}%')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=20, help='follows drawn per user')
+    parser.add_argument('--alpha', type=float, default=1.0, help='power-law exponent of the follow graph')
+    parser.add_argument('--page-depth', type=int, default=1000,
+                        help='which page of / the deep page rows ask for (at least 2)')
+    parser.add_argument('--requests', type=int, default=500, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=4, help='simultaneous clients')
+    parser.add_argument('--server', action='store_true', help='go through a real WSGI server instead of the test client')
+    parser.add_argument('--asgi', action='store_true', help='go through uvicorn and asgi.py instead (needs uvicorn installed)')
+    parser.add_argument('--write-mode', choices=('direct', 'queue'), default=os.environ.get('WRITE_MODE', 'direct'),
+                        help='commit each write in its request, or batch them on the writer thread (see writes.py)')
+    parser.add_argument('--routes', nargs='+', metavar='ROUTE', help="only measure these routes, e.g. / '/post/<id>'")
+    parser.add_argument('--mix', nargs='+', metavar='ROUTE',
+                        help='afterwards, run these routes at the same time with the clients split between them, '
+                             'e.g. --mix / /new_post for readers and writers together')
+    parser.add_argument('--sqlite-profile', choices=('default', 'performance'),
+                        default=os.environ.get('SQLITE_PROFILE', 'default'), help='see sqlite_profiles.py')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', help='empty directory for the benchmark database (default: a temp dir)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    args = parser.parse_args()
+    if args.page_depth < 2:
+        parser.error('--page-depth must be at least 2; page 1 is the plain / row')
+    if args.compare:
+        compare(*args.compare)
+    else:
+        benchmark(args)
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,12 @@
 #!/Users/khaledadad/Desktop/peewee/bin/python3
 
 import datetime
+import hashlib
 import os
+import pickle
 import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from getpass import getpass
 from optparse import OptionParser
 
@@ -57,18 +61,7 @@ def print_models(introspector, tables=None, preserve_order=False,
                                        include_views=include_views,
                                        snake_case=snake_case)
 
-    db_kwargs = introspector.get_database_kwargs()
-    header = HEADER % (
-        introspector.get_additional_imports(),
-        introspector.get_database_class().__name__,
-        introspector.get_database_name(),
-        ', **%s' % repr(db_kwargs) if db_kwargs else '')
-    print_(header)
-
-    if not ignore_unknown:
-        print_(UNKNOWN_FIELD)
-
-    print_(BASE_MODEL)
+    print_preamble(introspector, ignore_unknown)
 
     def _print_table(table, seen, accum=None):
         accum = accum or []
@@ -88,56 +81,8 @@ def print_models(introspector, tables=None, preserve_order=False,
                 if dest != table:
                     _print_table(dest, seen, accum + [table])
 
-        print_('class %s(BaseModel):' % database.model_names[table])
-        columns = database.columns[table].items()
-        if not preserve_order:
-            columns = sorted(columns)
-        primary_keys = database.primary_keys[table]
-        for name, column in columns:
-            skip = all([
-                name in primary_keys,
-                name == 'id',
-                len(primary_keys) == 1,
-                column.field_class in introspector.pk_classes])
-            if skip:
-                continue
-            if column.primary_key and len(primary_keys) > 1:
-                # If we have a CompositeKey, then we do not want to explicitly
-                # mark the columns as being primary keys.
-                column.primary_key = False
-
-            is_unknown = column.field_class is UnknownField
-            if is_unknown and ignore_unknown:
-                disp = '%s - %s' % (column.name, column.raw_column_type or '?')
-                print_('    # %s' % disp)
-            else:
-                print_('    %s' % column.get_field())
-
-        print_('')
-        print_('    class Meta:')
-        print_('        table_name = \'%s\'' % table)
-        multi_column_indexes = database.multi_column_indexes(table)
-        if multi_column_indexes:
-            print_('        indexes = (')
-            for fields, unique in sorted(multi_column_indexes):
-                print_('            ((%s), %s),' % (
-                    ', '.join("'%s'" % field for field in fields),
-                    unique,
-                ))
-            print_('        )')
-
-        if introspector.schema:
-            print_('        schema = \'%s\'' % introspector.schema)
-        if len(primary_keys) > 1:
-            pk_field_names = sorted([
-                field.name for col, field in columns
-                if col in primary_keys])
-            pk_list = ', '.join("'%s'" % pk for pk in pk_field_names)
-            print_('        primary_key = CompositeKey(%s)' % pk_list)
-        elif not primary_keys:
-            print_('        primary_key = False')
-        print_('')
-
+        print_model(introspector, database, table, preserve_order,
+                    ignore_unknown)
         seen.add(table)
 
     seen = set()
@@ -146,6 +91,336 @@ def print_models(introspector, tables=None, preserve_order=False,
             if not tables or table in tables:
                 _print_table(table, seen)
 
+def print_preamble(introspector, ignore_unknown=False):
+    db_kwargs = introspector.get_database_kwargs()
+    header = HEADER % (
+        introspector.get_additional_imports(),
+        introspector.get_database_class().__name__,
+        introspector.get_database_name(),
+        ', **%s' % repr(db_kwargs) if db_kwargs else '')
+    print_(header)
+
+    if not ignore_unknown:
+        print_(UNKNOWN_FIELD)
+
+    print_(BASE_MODEL)
+
+def print_model(introspector, database, table, preserve_order=False,
+                ignore_unknown=False):
+    print_('class %s(BaseModel):' % database.model_names[table])
+    columns = database.columns[table].items()
+    if not preserve_order:
+        columns = sorted(columns)
+    primary_keys = database.primary_keys[table]
+    for name, column in columns:
+        skip = all([
+            name in primary_keys,
+            name == 'id',
+            len(primary_keys) == 1,
+            column.field_class in introspector.pk_classes])
+        if skip:
+            continue
+        if column.primary_key and len(primary_keys) > 1:
+            # If we have a CompositeKey, then we do not want to explicitly
+            # mark the columns as being primary keys.
+            column.primary_key = False
+
+        is_unknown = column.field_class is UnknownField
+        if is_unknown and ignore_unknown:
+            disp = '%s - %s' % (column.name, column.raw_column_type or '?')
+            print_('    # %s' % disp)
+        else:
+            print_('    %s' % column.get_field())
+
+    print_('')
+    print_('    class Meta:')
+    print_('        table_name = \'%s\'' % table)
+    multi_column_indexes = database.multi_column_indexes(table)
+    if multi_column_indexes:
+        print_('        indexes = (')
+        for fields, unique in sorted(multi_column_indexes):
+            print_('            ((%s), %s),' % (
+                ', '.join("'%s'" % field for field in fields),
+                unique,
+            ))
+        print_('        )')
+
+    if introspector.schema:
+        print_('        schema = \'%s\'' % introspector.schema)
+    if len(primary_keys) > 1:
+        pk_field_names = sorted([
+            field.name for col, field in columns
+            if col in primary_keys])
+        pk_list = ', '.join("'%s'" % pk for pk in pk_field_names)
+        print_('        primary_key = CompositeKey(%s)' % pk_list)
+    elif not primary_keys:
+        print_('        primary_key = False')
+    print_('')
+
+# One query per engine listing everything introspection reads about each table,
+# as (table, detail) rows. A table whose rows hash the same as last run has not
+# changed, so its cached introspection results can be reused.
+FINGERPRINT_SQL = {
+    SqliteDatabase: (
+        "SELECT tbl_name, type || ' ' || name || ' ' || COALESCE(sql, '') "
+        "FROM sqlite_master WHERE name NOT LIKE 'sqlite_%%'"),
+    PostgresqlDatabase: (
+        "SELECT table_name, concat_ws(' ', column_name, ordinal_position, "
+        "data_type, udt_name, is_nullable, column_default, "
+        "character_maximum_length, numeric_precision, numeric_scale) "
+        "FROM information_schema.columns WHERE table_schema = %(schema)s "
+        "UNION ALL "
+        "SELECT tablename, indexdef FROM pg_indexes "
+        "WHERE schemaname = %(schema)s "
+        "UNION ALL "
+        "SELECT tc.table_name, concat_ws(' ', tc.constraint_name, "
+        "tc.constraint_type, kcu.column_name, ccu.table_name, "
+        "ccu.column_name) "
+        "FROM information_schema.table_constraints AS tc "
+        "JOIN information_schema.key_column_usage AS kcu "
+        "ON tc.constraint_name = kcu.constraint_name "
+        "AND tc.table_schema = kcu.table_schema "
+        "LEFT JOIN information_schema.constraint_column_usage AS ccu "
+        "ON tc.constraint_name = ccu.constraint_name "
+        "AND tc.table_schema = ccu.table_schema "
+        "WHERE tc.table_schema = %(schema)s"),
+    MySQLDatabase: (
+        "SELECT table_name, concat_ws(' ', column_name, ordinal_position, "
+        "column_type, is_nullable, column_default, column_key, extra) "
+        "FROM information_schema.columns WHERE table_schema = DATABASE() "
+        "UNION ALL "
+        "SELECT table_name, concat_ws(' ', index_name, non_unique, "
+        "seq_in_index, column_name) "
+        "FROM information_schema.statistics WHERE table_schema = DATABASE() "
+        "UNION ALL "
+        "SELECT table_name, concat_ws(' ', constraint_name, column_name, "
+        "referenced_table_name, referenced_column_name) "
+        "FROM information_schema.key_column_usage "
+        "WHERE table_schema = DATABASE() "
+        "AND referenced_table_name IS NOT NULL"),
+}
+
+def schema_fingerprints(introspector):
+    """Map each table to a hash of its definition, or None if the engine
+    isn't one we know how to fingerprint."""
+    db = introspector.metadata.database
+    for database_class, sql in FINGERPRINT_SQL.items():
+        if isinstance(db, database_class):
+            break
+    else:
+        return None
+
+    params = ()
+    if '%(schema)s' in sql:
+        sql = sql.replace('%(schema)s', db.param)
+        params = (introspector.schema or 'public',) * sql.count(db.param)
+
+    details = {}
+    for table, detail in db.execute_sql(sql, params):
+        details.setdefault(table, []).append(detail or '')
+    return dict(
+        (table, hashlib.sha1('\n'.join(sorted(rows)).encode('utf8')).hexdigest())
+        for table, rows in details.items())
+
+def introspect_table(introspector, table):
+    """Everything the introspector needs to know about one table, pickled.
+
+    Runs on a worker thread; peewee gives each thread its own connection.
+    """
+    metadata = introspector.metadata
+    schema = introspector.schema
+    try:
+        foreign_keys = metadata.get_foreign_keys(table, schema)
+    except ValueError as exc:
+        err(*exc.args)
+        foreign_keys = []
+    return pickle.dumps((
+        metadata.get_columns(table, schema),
+        metadata.get_primary_keys(table, schema),
+        foreign_keys,
+        metadata.get_indexes(table, schema)))
+
+class FetchedMetadata(object):
+    """Stands in for an introspector's metadata, answering from tables
+    introspected earlier so Introspector.introspect() needs no queries.
+
+    With a `table`, only that table and the tables it references are
+    visible, and only `table`'s foreign keys, which is all it takes to
+    generate that one model. Results are unpickled on every call, since
+    introspect() modifies them.
+    """
+    def __init__(self, metadata, results, table=None):
+        self.metadata = metadata
+        self.results = results
+        self.table = table
+        self.database = self  # introspect() calls metadata.database.get_tables()
+
+    def get_tables(self, schema=None):
+        if self.table is None:
+            return list(self.results)
+        return sorted(set([self.table]) | set(
+            fk.dest_table for fk in self.get_foreign_keys(self.table)))
+
+    def _get(self, table, part):
+        return pickle.loads(self.results[table])[part]
+
+    def get_columns(self, table, schema=None):
+        return self._get(table, 0)
+
+    def get_primary_keys(self, table, schema=None):
+        return self._get(table, 1)
+
+    def get_foreign_keys(self, table, schema=None):
+        if self.table is not None and table != self.table:
+            return []
+        return self._get(table, 2)
+
+    def get_indexes(self, table, schema=None):
+        return self._get(table, 3)
+
+    def __getattr__(self, attr):
+        return getattr(self.metadata, attr)
+
+def load_cache(cache_file, cache_key):
+    try:
+        with open(cache_file, 'rb') as fh:
+            cache = pickle.load(fh)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return {}
+    if cache.get('key') != cache_key:
+        return {}
+    return cache['tables']
+
+def save_cache(cache_file, cache_key, tables):
+    tmp = cache_file + '.tmp'
+    with open(tmp, 'wb') as fh:
+        pickle.dump({'key': cache_key, 'tables': tables}, fh,
+                    pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, cache_file)  # never leave a half-written cache behind
+
+def print_models_concurrently(introspector, tables=None, preserve_order=False,
+                              include_views=False, ignore_unknown=False,
+                              snake_case=True, jobs=None, cache_file=None):
+    """Like print_models(), but introspects tables on a thread pool and
+    prints each class as soon as it and the classes it references are
+    ready, so the order of classes can differ from run to run.
+
+    With a cache_file, introspection results are kept between runs and only
+    tables whose definition changed (see schema_fingerprints) are queried
+    again. Timings for each phase are written to stderr.
+    """
+    timings = []
+    started = phase_started = time.time()
+
+    def phase(name, detail=''):
+        now = time.time()
+        timings.append((name, now - phase_started, detail))
+        return now
+
+    db = introspector.metadata.database
+    names = db.get_tables(schema=introspector.schema)
+    if include_views:
+        names.extend(view.name for view in db.get_views(schema=introspector.schema))
+    if tables is not None:
+        names = [table for table in names if table in tables]
+    phase_started = phase('list tables', '%d tables' % len(names))
+
+    cached, fingerprints = {}, None
+    if cache_file:
+        fingerprints = schema_fingerprints(introspector)
+        if fingerprints is None:
+            err('Cannot fingerprint %s schemas, not using the cache.' %
+                type(db).__name__)
+        else:
+            cache_key = (type(db).__name__, introspector.get_database_name(),
+                         introspector.schema, peewee_version)
+            for table, (fingerprint, result) in load_cache(
+                    cache_file, cache_key).items():
+                if fingerprints.get(table) == fingerprint:
+                    cached[table] = result
+        phase_started = phase('fingerprint', '%d unchanged' % len(cached))
+
+    print_preamble(introspector, ignore_unknown)
+    results = {}  # table -> pickled introspection results
+    printed = set()
+    waiting = set()  # introspected, but a table they reference isn't printed yet
+    generate_time = [0.0]
+
+    def dependencies(table):
+        return set(fk.dest_table for fk in
+                   FetchedMetadata(None, results).get_foreign_keys(table))
+
+    def generate(table):
+        database = Introspector(
+            FetchedMetadata(introspector.metadata, results, table),
+            schema=introspector.schema).introspect(snake_case=snake_case)
+        print_model(introspector, database, table, preserve_order,
+                    ignore_unknown)
+
+    def print_ready():
+        progress = True
+        while progress:
+            progress = False
+            for table in sorted(waiting):
+                if dependencies(table) - printed - set([table]):
+                    continue
+                generate_started = time.time()
+                generate(table)
+                generate_time[0] += time.time() - generate_started
+                waiting.discard(table)
+                printed.add(table)
+                progress = True
+
+    fetched = 0
+    jobs = jobs or min(32, (os.cpu_count() or 1) + 4)  # ThreadPoolExecutor's default
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+        requested = set()
+
+        def need(table):
+            if table in requested:
+                return
+            requested.add(table)
+            if table in cached:
+                finished(table, cached[table])
+            else:
+                futures[pool.submit(introspect_table, introspector, table)] = table
+
+        def finished(table, result):
+            results[table] = result
+            waiting.add(table)
+            for dest in dependencies(table):
+                need(dest)  # tables outside --tables that this one references
+
+        for table in names:
+            need(table)
+        print_ready()
+        while futures:
+            done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+            for future in done:
+                table = futures.pop(future)
+                fetched += 1
+                finished(table, future.result())
+            print_ready()
+
+    for table in sorted(waiting):  # only reference cycles are left
+        print_('# Possible reference cycle: %s' % table)
+        waiting.discard(table)
+        generate(table)
+    phase_started = phase('introspect', '%d queried, %d from cache, %d jobs' % (
+        fetched, len(results) - fetched, jobs))
+    timings.append(('generate', generate_time[0], '%d classes' % len(results)))
+
+    if cache_file and fingerprints is not None:
+        save_cache(cache_file, cache_key, dict(
+            (table, (fingerprints[table], result))
+            for table, result in results.items() if table in fingerprints))
+        phase_started = phase('save cache')
+
+    for name, seconds, detail in timings:
+        sys.stderr.write('%-12s %8.3fs  %s\n' % (name, seconds, detail))
+    sys.stderr.write('%-12s %8.3fs\n' % ('total', time.time() - started))
+
 def print_header(cmd_line, introspector):
     timestamp = datetime.datetime.now()
     print_('# Code generated by:')
@@ -186,6 +461,13 @@ def get_option_parser():
        help='Ignore fields whose type cannot be determined.')
     ao('-L', '--legacy-naming', action='store_true', dest='legacy_naming',
        help='Use legacy table- and column-name generation.')
+    ao('-j', '--jobs', dest='jobs', type='int',
+       help=('Introspect tables on this many threads at once, printing each '
+             'model as soon as it is ready (model order may vary).'))
+    ao('-c', '--cache', dest='cache',
+       help=('Keep introspection results in this file and only re-introspect '
+             'tables whose definition changed since the last run. Implies '
+             '--jobs.'))
     return parser
 
 def get_connect_kwargs(options):
@@ -224,5 +506,12 @@ if __name__ == '__main__':
         cmd_line = ' '.join(raw_argv[1:])
         print_header(cmd_line, introspector)
 
-    print_models(introspector, tables, options.preserve_order, options.views,
-                 options.ignore_unknown, not options.legacy_naming)
+    if options.jobs or options.cache:
+        print_models_concurrently(
+            introspector, tables, options.preserve_order, options.views,
+            options.ignore_unknown, not options.legacy_naming,
+            jobs=options.jobs, cache_file=options.cache)
+    else:
+        print_models(introspector, tables, options.preserve_order,
+                     options.views, options.ignore_unknown,
+                     not options.legacy_naming)
@@ -1,14 +1,22 @@
 #!/usr/bin/env python3
 
 from collections import OrderedDict
-from datetime import datetime
+import csv
+from datetime import datetime, timedelta
+import json
 import sys
 import os
 from time import time
 
 from peewee import *
+from playhouse.sqlite_ext import FTS5Model, RowIDField, SearchField
 
-db = SqliteDatabase('diary.db')
+from sqlite_profiles import PRAGMA_PROFILES, SQLITE_PROFILE
+
+db = SqliteDatabase('diary.db', pragmas=PRAGMA_PROFILES[SQLITE_PROFILE])
+BROWSE_BATCH_SIZE = 50 # entries fetched from the database at a time while browsing
+IMPORT_BATCH_SIZE = 400 # rows per insert_many; 2 values a row stays under SQLite's old 999 variable limit
+EXPORT_FIELDS = ['content', 'timestamp']
 
 class Entry(Model):
     content = TextField() # using textfield instead of varchar b/c varchar require a maximum length
@@ -16,11 +24,63 @@ class Entry(Model):
     
     class Meta:
         database = db
+        indexes = (
+            (('timestamp', 'id'), False), # browsing newest first, a batch at a time
+        )
+
+class EntryIndex(FTS5Model):
+    """Full-text index over Entry.content; the triggers below keep it in step with Entry."""
+    rowid = RowIDField() # same as Entry.id
+    content = SearchField()
+
+    class Meta:
+        database = db
+        options = {'content': Entry, 'content_rowid': Entry.id} # read the text from Entry instead of storing it twice
+
+SEARCH_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS entry_ai AFTER INSERT ON entry BEGIN
+        INSERT INTO entryindex(rowid, content) VALUES (new.id, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS entry_ad AFTER DELETE ON entry BEGIN
+        INSERT INTO entryindex(entryindex, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS entry_au AFTER UPDATE ON entry BEGIN
+        INSERT INTO entryindex(entryindex, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO entryindex(rowid, content) VALUES (new.id, new.content);
+    END""",
+)
+
+def full_text_search():
+    """Whether this SQLite has FTS5; if not, searching falls back to LIKE."""
+    return EntryIndex.fts5_installed()
 
 def initialize():
     """Create the database and the table if they don't exist."""
     db.connect()
     db.create_tables([Entry], safe=True)
+    if full_text_search():
+        new_index = not EntryIndex.table_exists()
+        db.create_tables([EntryIndex], safe=True)
+        for trigger in SEARCH_TRIGGERS:
+            db.execute_sql(trigger)
+        if new_index and Entry.select().exists(): # the diary already had entries before there was an index
+            build_search_index()
+
+def build_search_index():
+    """(Re)build the full-text index from every entry in the diary."""
+    start = time()
+    EntryIndex.rebuild()
+    EntryIndex.optimize()
+    print(f'Search index built for {Entry.select().count()} entries in {time() - start:.1f}s.')
+
+def search(search_query):
+    """Entries matching search_query, best match first, each with a highlighted .snippet."""
+    phrase = '"{}"'.format(search_query.replace('"', '""')) # a quoted phrase, so the user's text can't be FTS syntax
+    return (Entry
+            .select(Entry, fn.snippet(EntryIndex._meta.entity, 0, '[', ']', '...', 12).alias('snippet'))
+            .join(EntryIndex, on=(Entry.id == EntryIndex.rowid))
+            .where(EntryIndex.match(phrase))
+            .order_by(EntryIndex.bm25())) # bm25 is smaller for better matches
 
 def clear():
     os.system('cls' if os.name == 'nt' else 'clear') # call cls if windows, call clear if on linux/mac
@@ -52,28 +112,69 @@ def add_entry():
 
 
 
-def view_entries(search_query=None):
+def iter_entries(before=None, where=None, batch_size=BROWSE_BATCH_SIZE):
+    """Yield entries newest first, one keyset batch at a time, so memory stays flat however big the diary is.
+
+    `before` (a datetime) jumps straight to entries written before then.
+    Each batch is read in full before any of it is handed out, so deleting
+    the entry being shown never touches a live cursor.
+    """
+    query = Entry.select().order_by(Entry.timestamp.desc(), Entry.id.desc())
+    if where is not None:
+        query = query.where(where)
+    if before:
+        query = query.where(Entry.timestamp < before)
+    last = None
+    while True:
+        batch = query
+        if last:
+            batch = batch.where(Tuple(Entry.timestamp, Entry.id) < Tuple(last.timestamp, last.id)) # carry on from the last one we saw
+        batch = list(batch.limit(batch_size).iterator()) # iterator() skips peewee's result cache
+        yield from batch
+        if len(batch) < batch_size:
+            return
+        last = batch[-1]
+
+def ask_date():
+    """Ask for a date and return the moment just after it ends, or None."""
+    answer = input('Jump to date (YYYY-MM-DD): ').strip()
+    try:
+        return datetime.strptime(answer, '%Y-%m-%d') + timedelta(days=1)
+    except ValueError:
+        return None
+
+def view_entries(search_query=None, before=None):
     """View previous entries."""
-    entries = Entry.select().order_by(Entry.timestamp.desc()) # oldest one shows up last, e.g. newest first
-    if search_query:
-        entries = entries.where(Entry.content.contains(search_query)) # if user adds search_query, we filter for matching criteria
+    ranked = bool(search_query) and full_text_search()
+    if ranked:
+        entries = search(search_query).iterator() # ranked by relevance instead of date
+    elif search_query:
+        entries = iter_entries(before, where=Entry.content.contains(search_query)) # if user adds search_query, we filter for matching criteria
+    else:
+        entries = iter_entries(before) # oldest one shows up last, e.g. newest first
 
     for entry in entries:
         timestamp = entry.timestamp.strftime('%A %B %d, %Y %I:%M%p')
         clear() # clear screen
         print(timestamp)
         print('='*len(timestamp))
+        if getattr(entry, 'snippet', None):
+            print(f'Match: {entry.snippet}\n')
         print(entry.content)
         print('\n\n'+'='*len(timestamp))
         print('n) next entry')
         print('d) delete entry')
+        if not ranked:
+            print('j) jump to date')
         print('q) return to main menu')
 
-        next_action = input('Action: [N/d/q] ').lower().strip()
+        next_action = input('Action: [N/d/j/q] ' if not ranked else 'Action: [N/d/q] ').lower().strip()
         if next_action == 'q':
             break
         elif next_action == 'd':
             delete_entry(entry)
+        elif next_action == 'j' and not ranked:
+            return view_entries(search_query, before=ask_date() or before) # start over from that date
 
 def search_entries():
     """Search entries for a string."""
@@ -86,6 +187,54 @@ def delete_entry(entry):
         print('Entry deleted!')
 
 
+def read_rows(path):
+    """Yield entry dicts from a .csv or .jsonl file one at a time, without loading the whole file."""
+    with open(path, newline='', encoding='utf-8') as file:
+        if path.endswith('.csv'):
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip(): # skip blank lines
+                    yield json.loads(line)
+
+def import_entries(path, batch_size=IMPORT_BATCH_SIZE):
+    """Bulk load entries from a .csv or .jsonl file, one transaction per batch."""
+    start = time()
+    imported = 0
+    rows = ((row['content'], datetime.fromisoformat(row['timestamp']) if row.get('timestamp') else datetime.now())
+            for row in read_rows(path))
+    for batch in chunked(rows, batch_size):
+        with db.atomic(): # one commit per batch instead of one per entry
+            Entry.insert_many(batch, fields=[Entry.content, Entry.timestamp]).execute()
+        imported += len(batch)
+        print(f'\rImported {imported} entries ({imported / (time() - start):.0f} rows/s)', end='', flush=True)
+    print()
+    return imported
+
+def export_rows():
+    """Every entry as a dict, streamed a batch at a time by iter_entries()."""
+    for entry in iter_entries():
+        yield {'content': entry.content, 'timestamp': str(entry.timestamp)}
+
+def export_entries(path):
+    """Write every entry to a .csv or .jsonl file."""
+    start = time()
+    exported = 0
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        if path.endswith('.csv'):
+            writer = csv.DictWriter(file, fieldnames=EXPORT_FIELDS)
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            write = lambda row: file.write(json.dumps(row) + '\n')
+        for row in export_rows():
+            write(row)
+            exported += 1
+            if exported % 10000 == 0:
+                print(f'\rExported {exported} entries ({exported / (time() - start):.0f} rows/s)', end='', flush=True)
+    print(f'\rExported {exported} entries ({exported / max(time() - start, 1e-9):.0f} rows/s)')
+    return exported
+
 # OrderedDict unlike a regular dictionary also remembers the order things are added
 menu = OrderedDict([
     ('a', add_entry),
@@ -95,4 +244,11 @@ menu = OrderedDict([
 
 if __name__ == '__main__':
     initialize()
-    menu_loop()
\ No newline at end of file
+    if sys.argv[1:] == ['reindex']: # python diary.py reindex
+        build_search_index()
+    elif len(sys.argv) == 3 and sys.argv[1] == 'import': # python diary.py import notes.jsonl (or .csv)
+        import_entries(sys.argv[2])
+    elif len(sys.argv) == 3 and sys.argv[1] == 'export': # python diary.py export notes.jsonl (or .csv)
+        export_entries(sys.argv[2])
+    else:
+        menu_loop()
\ No newline at end of file
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""Benchmark diary search: the FTS5 index against the old LIKE scan.
+
+Seeds a throwaway diary.db with synthetic entries, then times the same
+searches both ways:
+
+    fts5  diary.search(), ranked by bm25 through EntryIndex
+    like  iter_entries(where=Entry.content.contains(...)), what searching
+          did before the index, and still does when SQLite has no FTS5
+
+Each search is timed to its first screen (the first BROWSE_BATCH_SIZE
+entries, what view_entries() waits for) and to its last match:
+
+    python diary_benchmark.py                         # 1M entries
+    python diary_benchmark.py --entries 100000 --output search.json
+"""
+import argparse
+from datetime import datetime, timedelta
+from itertools import accumulate, islice
+import json
+import os
+import random
+import tempfile
+import time
+
+WORDS = 20000 # size of the made-up vocabulary
+SEARCHES = [ # (name, how to pick the search text from the vocabulary ranked by frequency)
+    ('common word', lambda vocabulary: vocabulary[10]),
+    ('rare word', lambda vocabulary: vocabulary[-10]),
+    ('two-word phrase', lambda vocabulary: f'{vocabulary[50]} {vocabulary[51]}'),
+    ('no match', lambda vocabulary: 'zzzzzz'),
+]
+
+
+def make_vocabulary(rng):
+    """WORDS distinct pronounceable words, most frequent first."""
+    syllables = [consonant + vowel for consonant in 'bdfgklmnprstvz' for vowel in 'aeiou']
+    vocabulary = set()
+    while len(vocabulary) < WORDS:
+        vocabulary.add(''.join(rng.choices(syllables, k=rng.randint(2, 4))))
+    return sorted(vocabulary)
+
+
+def seed(entries, vocabulary, rng):
+    """Fill the (empty) diary with entries of Zipf-distributed words, then build the index."""
+    import diary
+
+    weights = list(accumulate(1 / (rank + 1) for rank in range(len(vocabulary)))) # vocabulary[0] is the most common word
+    pair = f'{vocabulary[50]} {vocabulary[51]}' # so the phrase search has something to find
+    start = datetime.now() - timedelta(days=365 * 10)
+
+    def rows():
+        for number in range(entries):
+            words = rng.choices(vocabulary, cum_weights=weights, k=rng.randint(10, 40))
+            if number % 100 == 0:
+                words.insert(rng.randrange(len(words)), pair)
+            yield ' '.join(words), start + timedelta(minutes=5 * number)
+
+    diary.db.create_tables([diary.Entry]) # the index comes afterwards, in one go, like `diary.py reindex`
+    for batch in diary.chunked(rows(), diary.IMPORT_BATCH_SIZE):
+        with diary.db.atomic():
+            diary.Entry.insert_many(batch, fields=[diary.Entry.content, diary.Entry.timestamp]).execute()
+    diary.db.close()
+    diary.initialize() # finds entries but no index, so it builds one
+
+
+def timed(search, screen):
+    """(seconds to the first `screen` entries, seconds to the last entry, how many there were)."""
+    start = time.perf_counter()
+    entries = search() # peewee runs the query here, in .iterator()
+    count = len(list(islice(entries, screen)))
+    first = time.perf_counter() - start
+    count += sum(1 for _ in entries)
+    return first, time.perf_counter() - start, count
+
+
+def benchmark(args):
+    rng = random.Random(args.seed)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='diary-bench-')
+    path = os.path.join(workdir, 'diary.db')
+    if os.path.exists(path):
+        raise SystemExit(f'{workdir} already has a diary.db; give an empty --workdir')
+
+    os.environ['SQLITE_PROFILE'] = args.sqlite_profile # read when diary is imported, just below
+    import diary
+    diary.db.init(path, pragmas=diary.PRAGMA_PROFILES[args.sqlite_profile])
+    if not diary.full_text_search():
+        raise SystemExit('This SQLite was built without FTS5, so there is nothing to compare.')
+
+    print(f'Seeding {args.entries} entries in {workdir}...')
+    started = time.perf_counter()
+    vocabulary = make_vocabulary(rng)
+    seed(args.entries, vocabulary, rng)
+    print(f'Seeded in {time.perf_counter() - started:.1f}s.')
+
+    results = {}
+    for name, pick in SEARCHES:
+        text = pick(vocabulary)
+        ways = {
+            'fts5': lambda: diary.search(text).iterator(),
+            'like': lambda: diary.iter_entries(where=diary.Entry.content.contains(text)),
+        }
+        for way, search in ways.items():
+            runs = sorted(timed(search, diary.BROWSE_BATCH_SIZE) for _ in range(args.repeat))
+            first, last, count = runs[len(runs) // 2] # the median run, by time to the first screen
+            results[f'{name} ({way})'] = {'text': text, 'first_screen_ms': first * 1000,
+                                          'all_matches_ms': last * 1000, 'matches': count}
+            print(f'{name + " (" + way + ")":<24} first screen {first * 1000:9.1f}ms  '
+                  f'all matches {last * 1000:9.1f}ms  {count:>8} matches')
+    diary.db.close()
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'config': {'entries': args.entries, 'repeat': args.repeat, 'seed': args.seed,
+                   'sqlite_profile': args.sqlite_profile},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f'Results written to {args.output}')
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each search; the median is reported')
+    parser.add_argument('--sqlite-profile', choices=('default', 'performance'),
+                        default=os.environ.get('SQLITE_PROFILE', 'default'), help='see sqlite_profiles.py')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', help='empty directory for the benchmark database (default: a temp dir)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    benchmark(parser.parse_args())
+
+if __name__ == '__main__':
+    main()
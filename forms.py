@@ -1,17 +1,14 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, TextAreaField
-from wtforms.validators import (DataRequired, Regexp, ValidationError, Email,
+from wtforms.validators import (DataRequired, Regexp, Email,
                                 Length, EqualTo)
 
 from models import User
 
-def name_exists(form, field): # the field in this case is Username
-    if User.select().where(User.username == field.data).exists(): # returns a boolean of whether or not the record or username exists
-        raise ValidationError('User with that name already exists.')
-
-def email_exists(form, field): # the field in this case is Username
-    if User.select().where(User.email == field.data).exists(): # returns a boolean of whether or not the record or username exists
-        raise ValidationError('User with that email already exists.')
+CONFLICT_MESSAGES = {
+    'username': 'User with that name already exists.',
+    'email': 'User with that email already exists.',
+}
 
 
 class RegisterForm(FlaskForm):
@@ -24,7 +21,6 @@ class RegisterForm(FlaskForm):
                 message=('Username should be one word, letters, '
                         'numbers, and underscores only.')
             ),
-            name_exists
         ])
 
     email = StringField(
@@ -32,7 +28,6 @@ class RegisterForm(FlaskForm):
         validators=[
             DataRequired(),
             Email(),
-            email_exists
         ])
     
     password = PasswordField(
@@ -48,6 +43,16 @@ class RegisterForm(FlaskForm):
         validators=[DataRequired()]
     )
 
+    def validate(self, extra_validators=None):
+        """Check the fields, then check username and email are free with a single query."""
+        valid = super().validate(extra_validators)
+        if self.username.errors or self.email.errors:
+            return False # no point asking the database about a malformed name or email
+        for field in User.find_conflicts(self.username.data, self.email.data): # case insensitive usernames
+            self[field].errors.append(CONFLICT_MESSAGES[field])
+            valid = False
+        return valid
+
 class LoginForm(FlaskForm):
     email = StringField('Email', validators=[DataRequired(), Email()])
     password = PasswordField('Password', validators=[DataRequired()])
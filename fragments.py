@@ -0,0 +1,148 @@
+"""A cache for rendered HTML: single post <article>s and whole anonymous stream pages.
+
+Where it's kept is picked with the FRAGMENT_CACHE environment variable:
+'memory' (the default) is an LRU inside each worker, capped at
+FRAGMENT_CACHE_MAX_BYTES; 'sqlite' is a small SQLite file that every
+worker on the machine shares; 'off' turns caching off.
+"""
+from collections import OrderedDict
+import os
+import sqlite3
+import threading
+import time
+
+FRAGMENT_CACHE = os.environ.get('FRAGMENT_CACHE', 'memory')
+FRAGMENT_CACHE_MAX_BYTES = 32 * 1024 * 1024 # for the 'memory' store
+FRAGMENT_CACHE_PATH = 'fragments.db' # for the 'sqlite' store
+ARTICLE_TTL = 24 * 3600 # a post's HTML never changes, this just lets old ones fall out
+PAGE_TTL = 10 # seconds an anonymous stream page is served from the cache
+
+
+class MemoryStore:
+    """An LRU of strings that evicts the least recently used once they add up to more than max_bytes of UTF-8."""
+
+    def __init__(self, max_bytes=FRAGMENT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict() # key -> (expires at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                self._remove(key)
+                return None
+            self._items.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (time.time() + ttl, value)
+            self.size += self._bytes(key, value)
+            while self.size > self.max_bytes and self._items:
+                self._remove(next(iter(self._items))) # the least recently used
+
+    def _remove(self, key):
+        expires, value = self._items.pop(key)
+        self.size -= self._bytes(key, value)
+
+    @staticmethod
+    def _bytes(key, value):
+        return len(key.encode()) + len(value.encode()) # len() of a str counts characters, not bytes
+
+
+class SQLiteStore:
+    """Strings in a SQLite file, so every worker process shares one cache."""
+
+    def __init__(self, path=FRAGMENT_CACHE_PATH):
+        self.path = path
+        self._local = threading.local() # sqlite3 connections can't be shared between threads
+        self._sets = 0
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS fragment (key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+
+    def _connection(self):
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            self._local.connection.execute('PRAGMA journal_mode=wal') # workers read while one writes
+            self._local.connection.execute('PRAGMA synchronous=off') # it's a cache, losing it is fine
+        return self._local.connection
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value FROM fragment WHERE key = ? AND expires >= ?', (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl):
+        try:
+            connection = self._connection()
+            connection.execute('INSERT OR REPLACE INTO fragment VALUES (?, ?, ?)', (key, value, time.time() + ttl))
+            self._sets += 1
+            if self._sets % 1000 == 0: # now and then, throw out what has expired
+                connection.execute('DELETE FROM fragment WHERE expires < ?', (time.time(),))
+        except sqlite3.OperationalError: # another worker holds the lock; skipping a cache write is harmless
+            pass
+
+
+class FragmentCache:
+    """Rendered HTML by key, with hit/miss counts for each kind of fragment."""
+
+    def __init__(self, store):
+        self.store = store
+        self.hits = {}
+        self.misses = {}
+        self._lock = threading.Lock()
+
+    def get_or_render(self, kind, key, ttl, render):
+        """The cached HTML for `key`, or render() it and cache that."""
+        html = self._get(kind, key)
+        if html is None:
+            html = render()
+            self._set(key, html, ttl)
+        return html
+
+    async def aget_or_render(self, kind, key, ttl, render):
+        """get_or_render() for async views, where render() is a coroutine function."""
+        html = self._get(kind, key)
+        if html is None:
+            html = await render()
+            self._set(key, html, ttl)
+        return html
+
+    def _get(self, kind, key):
+        html = self.store.get(key) if self.store else None
+        with self._lock:
+            counts = self.misses if html is None else self.hits
+            counts[kind] = counts.get(kind, 0) + 1
+        return html
+
+    def _set(self, key, html, ttl):
+        if self.store:
+            self.store.set(key, html, ttl)
+
+    def generation(self):
+        """A number that changes whenever cached stream pages go stale; it's part of their keys."""
+        return (self.store.get('pages:generation') if self.store else None) or '0'
+
+    def invalidate_pages(self):
+        """Forget every cached stream page, e.g. after a new post."""
+        if self.store:
+            self.store.set('pages:generation', str(time.time_ns()), 365 * 24 * 3600)
+
+    def stats(self):
+        """Hits, misses and hit rate for each kind of fragment."""
+        with self._lock:
+            stats = {}
+            for kind in set(self.hits) | set(self.misses):
+                hits, misses = self.hits.get(kind, 0), self.misses.get(kind, 0)
+                stats[kind] = {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses)}
+            return stats
+
+
+STORES = {'memory': MemoryStore, 'sqlite': SQLiteStore, 'off': lambda: None}
+cache = FragmentCache(STORES[FRAGMENT_CACHE]())
@@ -0,0 +1,241 @@
+"""The follow graph held in memory: mutual follows and "who to follow" without multi-hop SQL.
+
+Relationship rows are loaded into CSR-style arrays: for each direction an
+offsets array indexed by user id, and one int array holding every user's
+neighbour ids, sorted, back to back. User u's followees are
+out_targets[out_offsets[u]:out_offsets[u + 1]].
+
+Follows and unfollows made by this process after loading are kept as small
+per-user overlays (Relationship.create/delete_instance report them). When the
+graph is reloaded after GRAPH_TTL, the ones newer than what was loaded are
+applied again. The arrays can be written to a snapshot file and
+memory-mapped, so workers start quickly and share the same pages.
+
+models imports this module, so this module only imports models inside the
+functions that read the database.
+"""
+from array import array
+from bisect import bisect_left
+from collections import Counter, deque
+import heapq
+import itertools
+import mmap
+import os
+import struct
+import threading
+import time
+
+GRAPH_SNAPSHOT = os.environ.get('GRAPH_SNAPSHOT', 'graph.snapshot') # shared by every worker
+GRAPH_TTL = 10 * 60 # seconds before the graph is reloaded and follows from other processes show up
+
+_HEADER = struct.Struct('<8sIqqd') # magic, format version, offsets length, edge count, built at
+_MAGIC = b'FOLLOWS1'
+_VERSION = 1
+
+
+def mutuals(user_id):
+    """Ids of the users who follow `user_id` back."""
+    return get_graph().mutuals(user_id)
+
+def followed_by_followees(user_id, target_id):
+    """Ids of the people `user_id` follows who follow `target_id`: "followed by X and Y"."""
+    return get_graph().followed_by_followees(user_id, target_id)
+
+def suggestions(user_id, k=10):
+    """Up to k (user id, how many of my followees follow them) for users I don't follow yet, best first."""
+    return get_graph().suggestions(user_id, k)
+
+
+def _load_csr(reverse=False):
+    """(offsets, targets) arrays for following, or for followers with reverse=True.
+
+    Both queries read Relationship in index order, (from_user, to_user) or
+    (to_user, from_user), so the rows come out grouped and sorted with no
+    sorting here, and each row is just an int for Python to handle.
+    """
+    import models
+
+    source, target = models.Relationship.from_user, models.Relationship.to_user
+    if reverse:
+        source, target = target, source
+    max_id = models.User.select(models.fn.MAX(models.User.id)).scalar() or 0
+    degrees = array('q', [0]) * (max_id + 2)
+    counts = (models.Relationship
+              .select(source, models.fn.COUNT(target))
+              .group_by(source))
+    for user_id, degree in models.DATABASE.execute(counts):
+        degrees[user_id + 1] = degree
+    offsets = array('q', itertools.accumulate(degrees)) # user u's neighbours start at offsets[u]
+    neighbours = (models.Relationship
+                  .select(target)
+                  .order_by(source, target))
+    targets = array('i', (row[0] for row in models.DATABASE.execute(neighbours)))
+    return offsets, targets
+
+
+def _intersect(first, second):
+    """The ids in both sorted sequences, in order."""
+    if len(first) > len(second):
+        first, second = second, first
+    if len(second) > 16 * len(first): # e.g. my 50 followees against a celebrity's followers: look each one up
+        found = []
+        for user_id in first:
+            position = bisect_left(second, user_id)
+            if position < len(second) and second[position] == user_id:
+                found.append(user_id)
+        return found
+    return sorted(set(first).intersection(second))
+
+
+class Graph:
+    """Who follows whom, as sorted int arrays plus this process's changes since loading."""
+
+    def __init__(self, out_offsets, out_targets, in_offsets, in_targets, built_at=None):
+        self.out_offsets, self.out_targets = out_offsets, out_targets
+        self.in_offsets, self.in_targets = in_offsets, in_targets
+        self.built_at = time.time() if built_at is None else built_at
+        self.loaded_at = time.monotonic()
+        self._added = ({}, {}) # (following, followers): user id -> set of ids added since loading
+        self._removed = ({}, {}) # and removed
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_database(cls):
+        import models
+
+        started = time.time() # follows committed after this may be missing, so get_graph() replays them
+        with models.DATABASE.atomic(): # both directions from the same snapshot of the table
+            out_offsets, out_targets = _load_csr()
+            in_offsets, in_targets = _load_csr(reverse=True)
+        return cls(out_offsets, out_targets, in_offsets, in_targets, built_at=started)
+
+    @classmethod
+    def from_snapshot(cls, path=GRAPH_SNAPSHOT):
+        """Map a snapshot written by save(); the arrays are read straight from the page cache."""
+        with open(path, 'rb') as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, offsets_length, edges, built_at = _HEADER.unpack_from(mapped)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(f'{path} is not a version {_VERSION} follow graph snapshot')
+        view = memoryview(mapped)
+        sections = []
+        position = _HEADER.size
+        for code, length in (('q', offsets_length), ('i', edges)) * 2:
+            size = struct.calcsize(code) * length
+            sections.append(view[position:position + size].cast(code))
+            position += size + (-size % 8) # each section starts 8 byte aligned
+        return cls(*sections, built_at=built_at)
+
+    def save(self, path=GRAPH_SNAPSHOT):
+        """Write the loaded arrays (not this process's changes) where from_snapshot() can map them."""
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(_HEADER.pack(_MAGIC, _VERSION, len(self.out_offsets), len(self.out_targets), self.built_at))
+            for section in (self.out_offsets, self.out_targets, self.in_offsets, self.in_targets):
+                data = section.tobytes() if isinstance(section, array) else bytes(section)
+                file.write(data + b'\0' * (-len(data) % 8))
+        os.replace(temporary, path) # readers see the old file or the new one, never half of one
+
+    def is_stale(self):
+        return time.monotonic() - self.loaded_at > GRAPH_TTL or time.time() - self.built_at > 2 * GRAPH_TTL
+
+    def _loaded(self, user_id, reverse=False):
+        """The sorted ids user_id followed (or that followed them) when the arrays were built."""
+        offsets, targets = (self.in_offsets, self.in_targets) if reverse else (self.out_offsets, self.out_targets)
+        if 0 <= user_id < len(offsets) - 1:
+            return targets[offsets[user_id]:offsets[user_id + 1]]
+        return () # joined after we loaded
+
+    def _neighbours(self, user_id, reverse=False):
+        """The sorted ids user_id follows (or that follow them, with reverse=True)."""
+        neighbours = self._loaded(user_id, reverse)
+        with self._lock:
+            added = self._added[reverse].get(user_id)
+            removed = self._removed[reverse].get(user_id)
+            if not added and not removed:
+                return neighbours
+            return sorted((set(neighbours) - (removed or set())) | (added or set()))
+
+    def following(self, user_id):
+        return self._neighbours(user_id)
+
+    def followers(self, user_id):
+        return self._neighbours(user_id, reverse=True)
+
+    def mutuals(self, user_id):
+        return _intersect(self.following(user_id), self.followers(user_id))
+
+    def followed_by_followees(self, user_id, target_id):
+        return _intersect(self.following(user_id), self.followers(target_id))
+
+    def suggestions(self, user_id, k=10):
+        following = self.following(user_id)
+        counts = Counter()
+        for followee in following:
+            counts.update(self.following(followee)) # Counter counts an int array in C, no Python loop per edge
+        counts.pop(user_id, None)
+        for followee in following:
+            counts.pop(followee, None) # already following them
+        return heapq.nlargest(k, counts.items(), key=lambda item: (item[1], -item[0]))
+
+    def _change(self, following, from_id, to_id):
+        """Record a follow (or unfollow); doing it twice is the same as once, so replays are safe."""
+        with self._lock:
+            for reverse, user_id, other_id in ((0, from_id, to_id), (1, to_id, from_id)):
+                loaded = self._loaded(user_id, reverse)
+                position = bisect_left(loaded, other_id)
+                was_loaded = position < len(loaded) and loaded[position] == other_id
+                changes, undo = (self._added, self._removed) if following else (self._removed, self._added)
+                undo[reverse].get(user_id, set()).discard(other_id) # e.g. unfollowing someone followed since we loaded
+                if was_loaded != following: # the arrays don't say so already
+                    changes[reverse].setdefault(user_id, set()).add(other_id)
+
+    def follow(self, from_id, to_id):
+        self._change(True, from_id, to_id)
+
+    def unfollow(self, from_id, to_id):
+        self._change(False, from_id, to_id)
+
+    def __len__(self):
+        return len(self.out_targets) # edges as loaded
+
+
+_graph = None
+_graph_lock = threading.Lock() # guards _graph and _changes
+_changes = deque() # (time, following, from id, to id) for each follow/unfollow this process committed
+
+def get_graph():
+    """The loaded Graph: mapped from GRAPH_SNAPSHOT if a fresh one exists, else read from the database and saved there."""
+    global _graph
+    with _graph_lock: # one thread loads while the others wait for it
+        if _graph is None or _graph.is_stale():
+            loaded = None
+            try:
+                if time.time() - os.path.getmtime(GRAPH_SNAPSHOT) < GRAPH_TTL:
+                    loaded = Graph.from_snapshot()
+            except (OSError, ValueError): # no snapshot yet, or not one we can read
+                pass
+            if loaded is None:
+                loaded = Graph.from_database()
+                loaded.save()
+            for at, following, from_id, to_id in _changes:
+                if at >= loaded.built_at: # newer than the arrays, e.g. a snapshot written before we followed
+                    loaded._change(following, from_id, to_id)
+            _graph = loaded
+        return _graph
+
+def _record(following, from_id, to_id):
+    now = time.time()
+    with _graph_lock: # not while another thread is swapping in a reloaded graph
+        _changes.append((now, following, from_id, to_id))
+        while _changes[0][0] < now - 2 * GRAPH_TTL: # any graph built before then is stale and gets reloaded
+            _changes.popleft()
+        if _graph is not None: # otherwise the first get_graph() picks it up
+            _graph._change(following, from_id, to_id)
+
+def followed(from_id, to_id):
+    """Relationship.create calls this once a follow is committed."""
+    _record(True, from_id, to_id)
+
+def unfollowed(from_id, to_id):
+    _record(False, from_id, to_id)
@@ -0,0 +1,114 @@
+"""Counts and times the SQL each request runs, and logs the slow statements.
+
+models.DATABASE is an InstrumentedSqliteDatabase, so every query goes
+through execute_sql() below. init_app() turns that into a Server-Timing
+header on every response and, in debug mode, a panel at the bottom of
+each page.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+import logging
+import re
+import time
+
+from flask import g
+from playhouse.pool import PooledSqliteDatabase
+
+SLOW_QUERY_MS = 100 # statements slower than this go to the slow query log
+SLOWEST_KEPT = 3 # how many of a request's slowest statements to keep
+
+slow_log = logging.getLogger('social.slow_queries')
+_active_stats = ContextVar('active_stats') # each request has its own, and they follow it into run_in_db() threads
+
+
+class QueryStats:
+    """The queries run while it was active: how many, total time, and the slowest few."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.slowest = [] # (ms, fingerprint), slowest first
+
+    def add(self, sql, elapsed_ms):
+        self.count += 1
+        self.total_ms += elapsed_ms
+        if len(self.slowest) < SLOWEST_KEPT or elapsed_ms > self.slowest[-1][0]:
+            self.slowest.append((elapsed_ms, fingerprint(sql)))
+            self.slowest.sort(reverse=True)
+            del self.slowest[SLOWEST_KEPT:]
+
+
+def fingerprint(sql):
+    """Normalize a statement so the same query with different values looks the same in the logs."""
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql) # string literals
+    sql = re.sub(r'\b\d+\b', '?', sql) # numbers
+    sql = re.sub(r'\(\s*\?(?:\s*,\s*\?)+\s*\)', '(?+)', sql) # IN (?, ?, ?) lists of any length
+    return re.sub(r'\s+', ' ', sql).strip()
+
+def _active():
+    """The QueryStats counting right now; max_queries() can nest inside a request."""
+    active = _active_stats.get(None)
+    if active is None:
+        active = []
+        _active_stats.set(active)
+    return active
+
+def record(sql, elapsed_ms):
+    for stats in _active():
+        stats.add(sql, elapsed_ms)
+    if elapsed_ms >= SLOW_QUERY_MS:
+        slow_log.warning('%.1fms %s', elapsed_ms, fingerprint(sql))
+
+def start():
+    """Start counting this request's (or thread's) queries, returning the QueryStats they go into."""
+    stats = QueryStats()
+    _active().append(stats)
+    return stats
+
+def stop(stats):
+    """Stop counting into `stats` and return it."""
+    if stats in _active():
+        _active().remove(stats)
+    return stats
+
+
+class InstrumentedSqliteDatabase(PooledSqliteDatabase):
+    """The pooled SQLite database, timing every statement it runs."""
+
+    def execute_sql(self, sql, *args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return super().execute_sql(sql, *args, **kwargs)
+        finally:
+            record(sql, (time.perf_counter() - start_time) * 1000)
+
+
+def init_app(app):
+    """Count queries per request and report them in a Server-Timing header."""
+    @app.before_request
+    def start_counting():
+        g.query_stats = start()
+
+    @app.after_request
+    def add_server_timing(response):
+        stats = g.get('query_stats')
+        if stats is not None:
+            response.headers.add('Server-Timing', f'db;dur={stats.total_ms:.1f};desc="{stats.count} queries"')
+        return response
+
+    @app.teardown_request
+    def stop_counting(exception):
+        if g.get('query_stats') is not None:
+            stop(g.query_stats)
+
+@contextmanager
+def max_queries(limit):
+    """Fail with AssertionError if the block runs more than `limit` queries, e.g. around a test client call."""
+    stats = start()
+    try:
+        yield stats
+    finally:
+        stop(stats)
+    if stats.count > limit:
+        slowest = '\n'.join(f'  {ms:.1f}ms {sql}' for ms, sql in stats.slowest)
+        raise AssertionError(f'{stats.count} queries run, expected at most {limit}; slowest:\n{slowest}')
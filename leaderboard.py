@@ -0,0 +1,122 @@
+"""Leaderboard queries over students.Student: the top N, a student's rank and the students around them.
+
+Ranks are competition ranks: students on the same points share a rank,
+and the next one down skips ahead (1, 2, 2, 4).
+"""
+from bisect import bisect_left, bisect_right
+from array import array
+import threading
+import time
+
+from students import Student
+import students
+
+CACHE_TTL = 300 # seconds before the board is reloaded even if this process changed nothing
+
+
+def top(n=10):
+    """The n highest scoring students as (rank, username, points)."""
+    return get_board().top(n)
+
+def rank(username):
+    """A student's rank, or None if there's no such student."""
+    return ask_board(lambda board: board.rank(username), None)
+
+def around(username, radius=2):
+    """The student plus up to `radius` students either side of them, as (rank, username, points)."""
+    return ask_board(lambda board: board.around(username, radius), [])
+
+def ask_board(question, missing):
+    """question(board) on the cached board, reloading it once if it has a student's points wrong."""
+    board = get_board()
+    try:
+        return question(board)
+    except StaleBoard: # their points changed since the board was loaded, e.g. a sync in another process
+        try:
+            return question(get_board(stale=board))
+        except StaleBoard: # and changed again while we reloaded
+            return missing
+
+def rank_in_db(username):
+    """A student's rank straight from the database, counting everyone above them with the points index."""
+    student = Student.get_or_none(Student.username == username)
+    if student is None:
+        return None
+    return Student.select().where(Student.points > student.points).count() + 1
+
+
+class StaleBoard(Exception):
+    """The student exists but the board doesn't have them on their current points."""
+
+
+class Board:
+    """Every student's points and username, sorted highest first, held in compact arrays."""
+
+    def __init__(self):
+        self.loaded_at = time.monotonic()
+        self.version = students.CHANGES
+        self.negated_points = array('q') # -points, so the arrays sort ascending and bisect works
+        self.usernames = [] # ties are sorted by username, same as the index
+        query = (Student
+                 .select(Student.points, Student.username)
+                 .order_by(Student.points.desc(), Student.username) # read straight off the points index
+                 .tuples()
+                 .iterator())
+        for points, username in query:
+            self.negated_points.append(-points)
+            self.usernames.append(username)
+
+    def is_stale(self):
+        return self.version != students.CHANGES or time.monotonic() - self.loaded_at > CACHE_TTL
+
+    def _rank_at(self, position):
+        return bisect_left(self.negated_points, self.negated_points[position]) + 1 # 1 + everyone with more points
+
+    def _row(self, position):
+        return self._rank_at(position), self.usernames[position], -self.negated_points[position]
+
+    def _position(self, username):
+        student = Student.get_or_none(Student.username == username) # a unique index lookup for their points
+        if student is None:
+            return None
+        low = bisect_left(self.negated_points, -student.points)
+        high = bisect_right(self.negated_points, -student.points)
+        position = bisect_left(self.usernames, username, low, high) # usernames are sorted within a tie
+        if position < high and self.usernames[position] == username:
+            return position
+        raise StaleBoard(username) # they joined, or their points changed, after the board was loaded
+
+    def top(self, n):
+        return [self._row(position) for position in range(min(n, len(self.usernames)))]
+
+    def rank(self, username):
+        position = self._position(username)
+        return None if position is None else self._rank_at(position)
+
+    def around(self, username, radius):
+        position = self._position(username)
+        if position is None:
+            return []
+        start = max(position - radius, 0)
+        end = min(position + radius + 1, len(self.usernames))
+        return [self._row(index) for index in range(start, end)]
+
+
+_board = None
+_board_lock = threading.Lock()
+
+def get_board(stale=None):
+    """The cached Board, reloaded if add_students() changed anything or it's older than CACHE_TTL.
+
+    Passing the board you have as `stale` reloads it too, unless another
+    thread already has.
+    """
+    global _board
+    with _board_lock: # one thread reloads while the others wait for it
+        if _board is None or _board is stale or _board.is_stale():
+            _board = Board()
+        return _board
+
+def initialize():
+    """Make sure the student table and its points index exist."""
+    students.db.create_tables([Student], safe=True)
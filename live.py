@@ -0,0 +1,69 @@
+"""Live stream updates: new posts pushed to open pages as Server-Sent Events.
+
+Post.create() publishes each new post to `hub` once it's committed. Every
+open /events stream is a Subscription that only wakes up when a post it
+cares about arrives, so an idle tab costs no queries at all. It does keep
+a thread waiting, though: a request thread under a WSGI server, or one of
+asgi.EVENT_WORKERS under asgi.py. The hub is per process: a client hears
+about posts made by the process serving it, and picks up anything else the
+next time it reconnects (see app.py).
+"""
+import queue
+import threading
+
+SUBSCRIBER_QUEUE_SIZE = 100 # posts buffered for a slow client before we give up on it
+KEEPALIVE = 15 # seconds between comments that stop proxies closing an idle stream
+STREAM_MAX_AGE = 5 * 60 # seconds before a stream ends and the browser reconnects, so dead ones don't linger
+RETRY_MS = 3000 # how long the browser waits before reconnecting
+
+
+class Subscription:
+    """One open stream: the posts waiting to be sent to it."""
+
+    def __init__(self, authors=None):
+        self.authors = authors # user ids whose posts we want, None for everyone's
+        self.posts = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False # fell too far behind; the stream should end so the client catches up from the database
+
+    def wants(self, post):
+        return self.authors is None or post.user_id in self.authors
+
+
+class Hub:
+    def __init__(self):
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, authors=None):
+        subscription = Subscription(authors)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, post):
+        """Hand a new post to every subscription that wants it; never blocks."""
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if subscription.wants(post):
+                try:
+                    subscription.posts.put_nowait(post)
+                except queue.Full:
+                    subscription.overflowed = True
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+hub = Hub()
+
+def format_event(data, event='message', id=None):
+    """One Server-Sent Event; `data` may span several lines."""
+    lines = [f'event: {event}']
+    if id is not None:
+        lines.append(f'id: {id}')
+    lines.extend(f'data: {line}' for line in data.splitlines() or [''])
+    return '\n'.join(lines) + '\n\n'
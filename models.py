@@ -1,13 +1,148 @@
+import asyncio
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 from datetime import datetime
+import functools
+import heapq
+import logging
 from operator import index
+import os
+import threading
+import time
 
-from flask_bcrypt import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from peewee import *
+from peewee import ModelSelect # not in peewee.__all__
 
-DATABASE =  SqliteDatabase('social.db')
+import fragments
+import graph
+from instrumentation import InstrumentedSqliteDatabase
+import live
+from passwords import ahash_password, hash_password
+from sqlite_profiles import PRAGMA_PROFILES, SQLITE_PROFILE
 
-class User(UserMixin, Model): #mixins are like chocolate chips, we put them before our main parent class Model
+POOL_MAX_CONNECTIONS = 8 # open connections kept around and handed from request to request
+POOL_STALE_TIMEOUT = 300 # seconds before an idle connection is thrown away and reopened
+POOL_WAIT_TIMEOUT = 10 # seconds a request waits for a free connection before giving up
+
+MAINTENANCE_INTERVAL = 15 * 60 # seconds between wal_checkpoint/optimize runs
+
+class SocialDatabase(InstrumentedSqliteDatabase):
+    """The app's database: pooled, timed, and able to run code once a transaction is saved."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._commit_hooks = threading.local() # transactions belong to a thread, so their hooks do too
+
+    def _hooks(self):
+        return self._commit_hooks.__dict__.setdefault('hooks', [])
+
+    def on_commit(self, callback):
+        """Call callback() once the current transaction commits, or now if there isn't one; a rollback drops it."""
+        if not self.in_transaction():
+            callback()
+        else:
+            self._hooks().append(callback)
+
+    def commit(self):
+        result = super().commit()
+        hooks = self._hooks()[:]
+        self._hooks().clear()
+        for callback in hooks:
+            try:
+                callback()
+            except Exception: # the data is saved; a broken hook mustn't make the write look failed
+                logging.getLogger('social.models').exception('on_commit hook failed')
+        return result
+
+    def rollback(self):
+        self._hooks().clear()
+        return super().rollback()
+
+DATABASE = SocialDatabase( # a PooledSqliteDatabase that times every query
+    'social.db',
+    pragmas=PRAGMA_PROFILES[SQLITE_PROFILE],
+    max_connections=POOL_MAX_CONNECTIONS,
+    stale_timeout=POOL_STALE_TIMEOUT,
+    timeout=POOL_WAIT_TIMEOUT,
+    check_same_thread=False # a pooled connection may be reused by a different worker thread
+)
+PAGE_SIZE = 100 # how many posts a stream page shows
+DB_WORKERS = POOL_MAX_CONNECTIONS // 2 # threads running queries for async views; the rest of the pool is left for everyone else
+# Whether run_in_db() hands its calls to the DB_WORKERS threads. asgi.py turns this on, so its
+# APP_WORKERS threads queue for a few database threads instead of all fighting over the pool;
+# under a WSGI server every request has its own thread anyway, and the hop would only add latency.
+OFFLOAD_QUERIES = False
+
+# How home streams are built, picked with the TIMELINE_STRATEGY environment variable:
+#   'read'   - merge the posts of everyone I follow when the page is asked for
+#   'fanout' - copy each new post into its followers' TimelineEntry rows when it's
+#              written, so reading a stream is one index range scan
+TIMELINE_STRATEGIES = ('read', 'fanout')
+TIMELINE_STRATEGY = os.environ.get('TIMELINE_STRATEGY', 'read')
+if TIMELINE_STRATEGY not in TIMELINE_STRATEGIES: # a typo would otherwise quietly mean 'read'
+    raise ValueError(f'TIMELINE_STRATEGY must be one of {", ".join(TIMELINE_STRATEGIES)}, not {TIMELINE_STRATEGY!r}')
+FANOUT_MAX_FOLLOWERS = 5000 # authors with more followers than this are merged at read time instead
+TIMELINE_BACKFILL = 200 # how many recent posts a new follow copies into the follower's timeline
+
+USER_CACHE_SIZE = 1024 # logged in users kept in memory between requests, 0 turns the cache off
+USER_CACHE_TTL = 60 # seconds before a cached user is read from the database again
+TAKEN_CACHE_TTL = 10 * 60 # seconds to remember that a username/email is taken
+FREE_CACHE_TTL = 5 # seconds to remember that one is free; short, since someone may take it
+
+_db_executor = None
+_db_executor_lock = threading.Lock()
+
+def _get_db_executor():
+    global _db_executor
+    with _db_executor_lock: # only the first async view makes the threads
+        if _db_executor is None:
+            _db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='db')
+        return _db_executor
+
+def _call_in_db(func, args, kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        if not DATABASE.is_closed() and not DATABASE.in_transaction():
+            DATABASE.close() # back to the pool; a db thread shouldn't sit on a connection between calls
+
+async def run_in_db(func, *args, **kwargs):
+    """Await func(*args, **kwargs) run on a database thread, leaving the event loop free meanwhile.
+
+    The call sees the same request globals (g, current_user, request) as the
+    caller, and its queries count towards the caller's query stats. Without
+    OFFLOAD_QUERIES it just runs here.
+    """
+    if not OFFLOAD_QUERIES:
+        return _call_in_db(func, args, kwargs)
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        _get_db_executor(), functools.partial(context.run, _call_in_db, func, args, kwargs))
+
+class AsyncSelect(ModelSelect):
+    """A SELECT that async code can await instead of iterating: `await query.alist()`."""
+
+    async def alist(self):
+        return await run_in_db(list, self)
+
+    async def aget(self):
+        return await run_in_db(self.get)
+
+class AsyncModel(Model):
+    """A model whose queries can be awaited, see run_in_db()."""
+
+    @classmethod
+    def select(cls, *fields):
+        return AsyncSelect(cls, fields or cls._meta.sorted_fields, is_default=not fields)
+
+    @classmethod
+    async def aget(cls, *query, **filters):
+        return await run_in_db(cls.get, *query, **filters)
+
+class User(UserMixin, AsyncModel): #mixins are like chocolate chips, we put them before our main parent class Model
     username = CharField(unique=True)
     email = CharField(unique=True)
     password = CharField(max_length=100)
@@ -20,13 +155,26 @@ class User(UserMixin, Model): #mixins are like chocolate chips, we put them befo
         order_by = ('-joined_at',) # list all users, ordered by joined at descending
 
     def get_posts(self):
-        return Post.select().where(Post.user == self)
+        return Post.with_authors().where(Post.user == self)
 
     def get_stream(self):
-        return Post.select().where(
-            (Post.user << self.following()) | #find all posts which are "<<"::"inside the set of" posts of people I follow
-            (Post.user == self)
-        )
+        """My posts and the posts of the people I follow, as sources for paginate()."""
+        if TIMELINE_STRATEGY == 'fanout':
+            return self.get_timeline()
+        authors = self.following().select(User.id) | User.select(User.id).where(User.id == self.id) # the people I follow, and me
+        return [(Post.with_authors(), (Post.timestamp, Post.id), authors)]
+
+    def get_timeline(self):
+        """The fan-out version of my stream, as (query, key) sources for paginate()."""
+        fanned_out = (Post.with_authors()
+                      .join_from(Post, TimelineEntry, on=(TimelineEntry.post == Post.id))
+                      .where(TimelineEntry.user == self))
+        broadcasters = (self.following().select(User.id)
+                        .join_from(User, Broadcaster, on=(Broadcaster.user == User.id))) # big accounts don't fan out, so their posts get merged in here
+        return [
+            (fanned_out, (TimelineEntry.timestamp, TimelineEntry.post)), # walk the timeline index, not the post table
+            (Post.with_authors(), (Post.timestamp, Post.id), broadcasters),
+        ]
 
     def following(self):
         """The users we are following."""
@@ -49,21 +197,189 @@ class User(UserMixin, Model): #mixins are like chocolate chips, we put them befo
             )
         )
 
+    def save(self, *args, **kwargs):
+        USER_CACHE.invalidate(self.id) # no other request should see the old row
+        fragments.cache.invalidate_pages() # cached pages may show the old username
+        saved = super().save(*args, **kwargs)
+        user_id = self.id
+        DATABASE.on_commit(lambda: USER_CACHE.invalidate(user_id)) # others read the old row until the commit, drop what they cached
+        return saved
+
+    def delete_instance(self, *args, **kwargs):
+        USER_CACHE.invalidate(self.id)
+        deleted = super().delete_instance(*args, **kwargs)
+        user_id = self.id
+        DATABASE.on_commit(lambda: USER_CACHE.invalidate(user_id))
+        return deleted
+
+    @classmethod
+    def by_username(cls, username):
+        """Get a user by username, ignoring case, using the NOCASE index."""
+        return cls.get(cls.username.collate('NOCASE') == username)
+
+    def is_following(self, other):
+        """Whether I follow `other`, without loading everyone I follow."""
+        return Relationship.select().where(
+            (Relationship.from_user == self) &
+            (Relationship.to_user == other)
+        ).exists()
+
+    @property
+    def stats(self):
+        """My cached post/follower/following counts."""
+        try:
+            return UserStats.get_by_id(self.id)
+        except DoesNotExist: # counts were never cached for me, so work them out once
+            return UserStats.refresh(self.id)
+
+    @classmethod
+    def find_conflicts(cls, username, email):
+        """Which of 'username' and 'email' are already taken, as a set, checked with one query.
+
+        Answers are cached (taken ones for longer than free ones), so bots
+        probing the same names over and over don't reach the database.
+        """
+        keys = {'username': ('username', username.lower()), 'email': ('email', email)}
+        taken = {field: UNIQUENESS_CACHE.get(key) for field, key in keys.items()}
+        if None in taken.values(): # something we haven't seen lately, so ask about both at once
+            rows = list(cls.select(cls.username, cls.email).where(
+                (cls.username.collate('NOCASE') == username) | (cls.email == email)
+            ))
+            taken = {
+                'username': any(row.username.lower() == username.lower() for row in rows),
+                'email': any(row.email == email for row in rows),
+            }
+            for field, is_taken in taken.items():
+                UNIQUENESS_CACHE.set(keys[field], is_taken)
+        return {field for field, is_taken in taken.items() if is_taken}
+
     @classmethod #a method that belongs to a class, that can create the class it belongs to 
     def create_user(cls, username, email, password, admin=False): # with cls, it will create the user model instance when it runs this method and use it in the create
+        if cls.find_conflicts(username, email): # usually answered from the cache the form just filled
+            raise ValueError('User already exists')
+        password = hash_password(password) # only hash once we know the insert should work, and outside the transaction
+        cls._insert_user(username, email, password, admin)
+
+    @classmethod
+    async def acreate_user(cls, username, email, password, admin=False):
+        """create_user() for async views: awaits the conflict check, the hash and the insert."""
+        if await run_in_db(cls.find_conflicts, username, email):
+            raise ValueError('User already exists')
+        password = await ahash_password(password)
+        await run_in_db(cls._insert_user, username, email, password, admin)
+
+    @classmethod
+    def _insert_user(cls, username, email, password, admin):
+        """Insert a user whose password is already hashed, keeping the uniqueness cache in step."""
         try:
             with DATABASE.transaction(): #transaction says, try this thing out, if it works, keep going, if it doesn't work, remove whatever action you just did -prevent getting locked out from Database
                 cls.create(
                     username=username,
                     email=email,
-                    password=generate_password_hash(password),
+                    password=password,
                     is_admin=admin
                 )
-        except IntegrityError: # thrown if username or email are not actually unique
+        except IntegrityError: # thrown if username or email are not actually unique, e.g. someone beat us to it
+            UNIQUENESS_CACHE.forget(('username', username.lower()))
+            UNIQUENESS_CACHE.forget(('email', email))
             raise ValueError('User already exists') # raise a value error
+        UNIQUENESS_CACHE.set(('username', username.lower()), True)
+        UNIQUENESS_CACHE.set(('email', email), True)
+
+
+User.add_index(User.index(User.username.collate('NOCASE'), name='user_username_nocase')) # case-insensitive lookups
+
+class UserCache:
+    """User rows by id, kept for `ttl` seconds and evicting the least recently used past `size`."""
+
+    def __init__(self, size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._rows = OrderedDict() # user id -> (time cached, column values)
+        self._loading = {} # user id -> token of the read in flight; invalidate() takes it away
+        self._lock = threading.Lock() # requests on other threads share the cache
+
+    def get(self, user_id):
+        """A fresh User for `user_id`, from memory if we can; raises DoesNotExist like User.get()."""
+        with self._lock:
+            cached = self._rows.get(user_id)
+            if cached and time.monotonic() - cached[0] < self.ttl:
+                self._rows.move_to_end(user_id)
+                self.hits += 1
+                user = User(**cached[1]) # each caller gets its own instance to play with
+                user._dirty.clear()
+                return user
+            self.misses += 1
+            token = self._loading[user_id] = object()
+        try:
+            user = User.get_by_id(user_id)
+        except Exception:
+            with self._lock:
+                if self._loading.get(user_id) is token:
+                    del self._loading[user_id]
+            raise
+        with self._lock:
+            if self._loading.get(user_id) is not token:
+                return user # invalidated while we read it (or a newer read is in flight), so don't keep what we read
+            del self._loading[user_id]
+            if self.size:
+                self._rows[user_id] = (time.monotonic(), dict(user.__data__))
+                self._rows.move_to_end(user_id)
+                while len(self._rows) > self.size:
+                    self._rows.popitem(last=False) # the least recently used
+        return user
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._rows.pop(user_id, None)
+            self._loading.pop(user_id, None) # a read already under way may have the old row
+
+    def stats(self):
+        """Hits, misses and hit rate since the process started."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self._rows),
+            }
+
+USER_CACHE = UserCache()
+
+class UniquenessCache:
+    """Remembers whether ('username' or 'email', value) pairs are taken, for find_conflicts()."""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._answers = {} # key -> (expires at, taken)
+        self._lock = threading.Lock()
 
+    def get(self, key):
+        """True or False if we know, None if we have to ask the database."""
+        with self._lock:
+            answer = self._answers.get(key)
+        if answer and answer[0] > time.monotonic():
+            return answer[1]
+        return None
 
-class Post(Model):
+    def set(self, key, taken):
+        ttl = TAKEN_CACHE_TTL if taken else FREE_CACHE_TTL
+        with self._lock:
+            if len(self._answers) >= self.max_size: # crude, but it keeps a flood of probes from eating memory
+                self._answers.clear()
+            self._answers[key] = (time.monotonic() + ttl, taken)
+
+    def forget(self, key):
+        with self._lock:
+            self._answers.pop(key, None)
+
+UNIQUENESS_CACHE = UniquenessCache()
+
+
+class Post(AsyncModel):
     timestamp = DateTimeField(default=datetime.now)
     user = ForeignKeyField(
         # rel_model= User ... for some reason this isn't working, I just use User below and it runs
@@ -75,18 +391,315 @@ class Post(Model):
     class Meta:
         database = DATABASE
         order_by = ('-timestamp',) #display newest items first, because those items are tuples, we need to make sure we include the comma
+        indexes = (
+            (('user', 'timestamp', 'id'), False), # serves a user's posts newest first, and the keyset pagination below
+            (('timestamp', 'id'), False), # same, for the stream of everyone's posts
+        )
+
+    @classmethod
+    def with_authors(cls):
+        """Select posts with their author joined in."""
+        return cls.select(cls, User).join(User) # one query fills post.user, so templates don't run a query per post
 
-class Relationship(Model):
+    @classmethod
+    def create(cls, **query):
+        with DATABASE.atomic(): # the post and its timeline copies go in together
+            post = super().create(**query)
+            UserStats.bump(post.user_id, posts=1)
+            if TIMELINE_STRATEGY == 'fanout':
+                fan_out(post)
+            DATABASE.on_commit(fragments.cache.invalidate_pages) # the new post belongs at the top of the stream
+            DATABASE.on_commit(lambda: live.hub.publish(post)) # and on every open page that shows it
+        return post
+
+class Relationship(AsyncModel):
     from_user = ForeignKeyField(User, related_name=('relationships'))#who are the people related to me
     to_user = ForeignKeyField(User, related_name=('related_to'))#who are the people I'm related to
 
     class Meta:
         database = DATABASE
-        index = ( #allows us to specify how to find data as well as define a unique index, each index is a tuple
+        indexes = ( #allows us to specify how to find data as well as define a unique index, each index is a tuple
             (('from_user', 'to_user'), True), #true states that UNIQUE is required
+            (('to_user', 'from_user'), False), #followers() goes this way round
         )
 
+    @classmethod
+    def create(cls, **query):
+        with DATABASE.atomic():
+            relationship = super().create(**query)
+            UserStats.bump(relationship.from_user_id, following=1)
+            UserStats.bump(relationship.to_user_id, followers=1)
+            if TIMELINE_STRATEGY == 'fanout':
+                backfill(relationship.from_user_id, relationship.to_user_id)
+            DATABASE.on_commit(lambda: graph.followed(relationship.from_user_id, relationship.to_user_id))
+        return relationship
+
+    def delete_instance(self, *args, **kwargs):
+        with DATABASE.atomic():
+            if TIMELINE_STRATEGY == 'fanout':
+                prune(self.from_user_id, self.to_user_id)
+            deleted = super().delete_instance(*args, **kwargs)
+            if deleted:
+                UserStats.bump(self.from_user_id, following=-1)
+                UserStats.bump(self.to_user_id, followers=-1)
+                DATABASE.on_commit(lambda: graph.unfollowed(self.from_user_id, self.to_user_id))
+            return deleted
+
+class UserStats(Model):
+    """Cached counts for the profile header, kept in step by Post and Relationship."""
+    user = ForeignKeyField(User, primary_key=True, related_name='+')
+    posts = IntegerField(default=0)
+    followers = IntegerField(default=0)
+    following = IntegerField(default=0)
+
+    class Meta:
+        database = DATABASE
+
+    @classmethod
+    def counts(cls):
+        """A query of (user id, posts, followers, following) counted from scratch."""
+        posts = Post.select(fn.COUNT(Post.id)).where(Post.user == User.id)
+        followers = Relationship.select(fn.COUNT(Relationship.id)).where(Relationship.to_user == User.id)
+        following = Relationship.select(fn.COUNT(Relationship.id)).where(Relationship.from_user == User.id)
+        return User.select(User.id, posts, followers, following)
+
+    @classmethod
+    def refresh(cls, user_id):
+        """Recount one user's stats and save them."""
+        with DATABASE.atomic():
+            (cls.insert_from(cls.counts().where(User.id == user_id),
+                             [cls.user, cls.posts, cls.followers, cls.following])
+                .on_conflict_replace()
+                .execute())
+            return cls.get_by_id(user_id)
+
+    @classmethod
+    def bump(cls, user_id, **deltas):
+        """Add to a user's cached counts, e.g. UserStats.bump(user.id, posts=1)."""
+        updated = (cls.update({getattr(cls, name): getattr(cls, name) + delta
+                               for name, delta in deltas.items()})
+                   .where(cls.user == user_id)
+                   .execute())
+        if not updated: # nothing cached yet; counting now already includes this change
+            cls.refresh(user_id)
+
+def rebuild_stats():
+    """Recount every user's cached stats in one statement, e.g. if they ever drift."""
+    with DATABASE.atomic():
+        (UserStats.insert_from(UserStats.counts(),
+                               [UserStats.user, UserStats.posts, UserStats.followers, UserStats.following])
+            .on_conflict_replace()
+            .execute())
+
+class TimelineEntry(Model):
+    """A post copied into one user's home timeline by the 'fanout' strategy."""
+    user = ForeignKeyField(User, related_name='timeline') # whose timeline this is
+    post = ForeignKeyField(Post, on_delete='CASCADE')
+    timestamp = DateTimeField() # a copy of post.timestamp so the index below can do the sorting
+
+    class Meta:
+        database = DATABASE
+        indexes = (
+            (('user', 'timestamp', 'post'), True),
+        )
+
+class Broadcaster(Model):
+    """A user with too many followers to fan out; their posts are merged in at read time."""
+    user = ForeignKeyField(User, unique=True)
+
+    class Meta:
+        database = DATABASE
+
+def fan_out(post):
+    """Copy a new post into the timelines of its author and their followers."""
+    author = post.user_id
+    rows = [(author, post.id, post.timestamp)] # you always see your own posts
+    if not Broadcaster.select().where(Broadcaster.user == author).exists():
+        followers = Relationship.select(Relationship.from_user).where(Relationship.to_user == author)
+        if UserStats.get_by_id(author).followers > FANOUT_MAX_FOLLOWERS: # bumped by Post.create just now, so it's there
+            Broadcaster.create(user=author) # once someone is this big, readers merge them in from now on
+        else:
+            rows.extend((follower.from_user_id, post.id, post.timestamp) for follower in followers)
+    for batch in chunked(rows, 500):
+        TimelineEntry.insert_many(batch, fields=[
+            TimelineEntry.user, TimelineEntry.post, TimelineEntry.timestamp
+        ]).execute()
+
+def backfill(user_id, followed_id):
+    """Copy the recent posts of someone I just followed into my timeline."""
+    if Broadcaster.select().where(Broadcaster.user == followed_id).exists():
+        return # already merged in at read time
+    recent = (Post.select(Value(user_id), Post.id, Post.timestamp)
+              .where(Post.user == followed_id)
+              .order_by(Post.timestamp.desc(), Post.id.desc())
+              .limit(TIMELINE_BACKFILL))
+    (TimelineEntry
+     .insert_from(recent, [TimelineEntry.user, TimelineEntry.post, TimelineEntry.timestamp])
+     .on_conflict_ignore()
+     .execute())
+
+def prune(user_id, unfollowed_id):
+    """Take the posts of someone I unfollowed back out of my timeline."""
+    (TimelineEntry.delete()
+     .where((TimelineEntry.user == user_id) &
+            (TimelineEntry.post << Post.select(Post.id).where(Post.user == unfollowed_id)))
+     .execute())
+
+def rebuild_timelines():
+    """Fill every timeline from scratch, e.g. after switching TIMELINE_STRATEGY to 'fanout'."""
+    with DATABASE.atomic():
+        TimelineEntry.delete().execute()
+        for user in User.select():
+            own = (Post.select(Value(user.id), Post.id, Post.timestamp)
+                   .where(Post.user == user)
+                   .order_by(Post.timestamp.desc(), Post.id.desc())
+                   .limit(TIMELINE_BACKFILL))
+            TimelineEntry.insert_from(own, [
+                TimelineEntry.user, TimelineEntry.post, TimelineEntry.timestamp
+            ]).execute()
+            for followed in user.following():
+                backfill(user.id, followed.id)
+
+def encode_cursor(post):
+    """Turn a post's (timestamp, id) into an opaque cursor string."""
+    raw = f'{post.timestamp}|{post.id}'.encode()
+    return urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Turn a cursor string back into (timestamp, id), raising ValueError if it's garbage."""
+    try:
+        raw = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, post_id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(post_id)
+    except (TypeError, UnicodeDecodeError, ValueError) as exc: # binascii.Error is a ValueError too
+        raise ValueError('Invalid cursor') from exc
+
+def keyset_page(query, key, cursor=None, before=False, per_page=PAGE_SIZE):
+    """Limit `query` to the page past `cursor`, ordered on its (timestamp, id) `key`."""
+    timestamp, post_id = key
+    if cursor:
+        row, edge = Tuple(timestamp, post_id), Tuple(*decode_cursor(cursor))
+        query = query.where(row > edge if before else row < edge)
+    if before: # going back towards newer posts, so walk the index the other way
+        query = query.order_by(timestamp.asc(), post_id.asc())
+    else:
+        query = query.order_by(timestamp.desc(), post_id.desc())
+    return query.limit(per_page + 1) # one extra row tells us if there's another page
+
+def page_queries(query, after=None, before=None, per_page=PAGE_SIZE):
+    """The queries paginate() runs for one page, one per source."""
+    sources = query if isinstance(query, list) else [(query, (Post.timestamp, Post.id))]
+    cursor = before or after
+    pages = []
+    for source, key, *authors in sources:
+        if authors: # read a page from each author's (user, timestamp, id) index range, then sort just those
+            author = authors[0].alias('author')
+            AuthorPost = Post.alias()
+            author_page = keyset_page(AuthorPost.select(AuthorPost.id).where(AuthorPost.user == author.c.id),
+                                      (AuthorPost.timestamp, AuthorPost.id), cursor, before, per_page)
+            source = source.join_from(Post, author, on=Post.id.in_(author_page))
+        pages.append(keyset_page(source, key, cursor, before, per_page))
+    return pages
+
+def paginate(query, after=None, before=None, per_page=PAGE_SIZE):
+    """Get one page of a post query, newest first, using keyset pagination.
+
+    Pages are found by comparing against the (timestamp, id) of the last post
+    seen instead of using OFFSET, so page 1000 costs the same as page 1.
+    `query` can also be a list of (query, (timestamp column, id column))
+    sources, which are paged separately and merged. A source can carry a
+    third item, a query of user ids: then only the next page of each of those
+    users' posts is read, so a stream of many authors doesn't sort all of
+    their posts for every page.
+    Returns (posts, older_cursor, newer_cursor); a cursor is None when there
+    is nothing further in that direction.
+    """
+    going_newer = bool(before) # pages come back oldest first then, so flip them afterwards
+    pages = page_queries(query, after, before, per_page)
+
+    posts, seen = [], set()
+    for post in heapq.merge(*pages, key=lambda post: (post.timestamp, post.id), reverse=not going_newer):
+        if post.id not in seen: # a post can show up in more than one source
+            seen.add(post.id)
+            posts.append(post)
+        if len(posts) > per_page:
+            break
+    has_more = len(posts) > per_page
+    posts = posts[:per_page]
+    if going_newer:
+        posts.reverse()
+        has_newer, has_older = has_more, True
+    else:
+        has_older, has_newer = has_more, bool(after)
+    older = encode_cursor(posts[-1]) if posts and has_older else None
+    newer = encode_cursor(posts[0]) if posts and has_newer else None
+    return posts, older, newer
+
+def run_maintenance(database=DATABASE):
+    """Fold the WAL back into the database file and refresh the query planner's statistics."""
+    with database.connection_context():
+        database.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)') # keeps the -wal file from growing forever
+        database.execute_sql('PRAGMA optimize')
+
+_maintenance = None
+_maintenance_lock = threading.Lock()
+
+def start_maintenance(database=DATABASE, interval=MAINTENANCE_INTERVAL):
+    """Call run_maintenance() every `interval` seconds on a background thread; only the first call starts it."""
+    global _maintenance
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                run_maintenance(database)
+            except OperationalError: # e.g. the database was busy; try again next time
+                pass
+    with _maintenance_lock:
+        if _maintenance is None:
+            _maintenance = threading.Thread(target=loop, name='sqlite-maintenance', daemon=True)
+            _maintenance.start()
+        return _maintenance
+
+def missing_indexes(models=None):
+    """The declared indexes that an existing database doesn't have yet, as (model, index) pairs."""
+    missing = []
+    for model in models or MODELS:
+        if not model.table_exists():
+            continue # create_tables() will make the table and its indexes together
+        existing = {index.name for index in DATABASE.get_indexes(model._meta.table_name)}
+        missing.extend((model, index) for index in model._meta.fields_to_index()
+                       if index._name not in existing)
+    return missing
+
+def dedupe_relationships():
+    """Delete repeated follows, which the unique index below would refuse to be built over."""
+    keep = (Relationship
+            .select(fn.MIN(Relationship.id))
+            .group_by(Relationship.from_user, Relationship.to_user))
+    deleted = Relationship.delete().where(Relationship.id.not_in(keep)).execute()
+    if deleted and UserStats.table_exists():
+        rebuild_stats() # the duplicates were counted too
+    return deleted
+
+def build_indexes(models=None):
+    """Create whatever missing_indexes() finds and return their names.
+
+    Each index is built in its own transaction, so writers only ever wait on
+    one build at a time instead of the whole lot.
+    """
+    built = []
+    for model, index in missing_indexes(models):
+        with DATABASE.atomic():
+            if model is Relationship and index._unique:
+                dedupe_relationships()
+            DATABASE.execute(index)
+        built.append(index._name)
+    return built
+
+MODELS = [User, Post, Relationship, UserStats, TimelineEntry, Broadcaster]
+
 def initialize():
     DATABASE.connect()
-    DATABASE.create_tables([User, Post, Relationship], safe=True)
+    build_indexes() # tables made before an index was declared get it here
+    DATABASE.create_tables(MODELS, safe=True)
     DATABASE.close()
@@ -0,0 +1,80 @@
+"""Password hashing on a small process pool, so bcrypt doesn't hold up request threads.
+
+The request still waits for its hash (Flask gives every request a thread,
+async views included), but the hashing itself happens in HASH_WORKERS
+other processes. So however many logins arrive at once, only that many
+hashes compete with the rest of the app for CPU. Past HASH_QUEUE_LIMIT
+waiting hashes, requests are turned away with PoolBusy instead of queueing.
+"""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+import multiprocessing
+import os
+import threading
+
+from flask_bcrypt import generate_password_hash, check_password_hash
+
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12)) # each extra round doubles the cost of a hash
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', os.cpu_count() or 2)) # processes doing the hashing; 0 hashes in the request thread instead
+HASH_QUEUE_LIMIT = max(HASH_WORKERS, 1) * 4 # hashes running or waiting before we start turning requests away
+# Workers are started from a fresh process rather than forked from the server, whose other
+# threads (requests, database threads, the writer) could be holding locks at the moment of the fork
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+HASH_TIMEOUT = 10 # seconds a request waits for its hash
+
+class PoolBusy(Exception):
+    """Too many hashes are already queued; the caller should answer 503."""
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(HASH_QUEUE_LIMIT)
+
+def _get_executor():
+    global _executor
+    with _executor_lock: # only the first request makes the pool
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=HASH_WORKERS,
+                                            mp_context=multiprocessing.get_context(START_METHOD))
+        return _executor
+
+def _submit(func, *args):
+    """Start func(*args) in the pool and return its Future, or raise PoolBusy if the queue is full."""
+    if not _slots.acquire(blocking=False): # fail fast instead of piling up behind a login storm
+        raise PoolBusy()
+    try:
+        future = _get_executor().submit(func, *args)
+    except Exception:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda future: _slots.release())
+    return future
+
+def _run(func, *args):
+    """Run func(*args) in the pool and wait for it."""
+    if not HASH_WORKERS:
+        return func(*args)
+    try:
+        return _submit(func, *args).result(timeout=HASH_TIMEOUT)
+    except TimeoutError:
+        raise PoolBusy()
+
+async def _arun(func, *args):
+    """_run() for async views: awaits the pool instead of blocking the event loop."""
+    if not HASH_WORKERS:
+        return func(*args)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(_submit(func, *args)), HASH_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise PoolBusy()
+
+def hash_password(password):
+    return _run(generate_password_hash, password, BCRYPT_ROUNDS)
+
+async def ahash_password(password):
+    return await _arun(generate_password_hash, password, BCRYPT_ROUNDS)
+
+def check_password(pw_hash, password):
+    return _run(check_password_hash, pw_hash, password)
+
+async def acheck_password(pw_hash, password):
+    return await _arun(check_password_hash, pw_hash, password)
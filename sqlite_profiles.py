@@ -0,0 +1,22 @@
+"""SQLite pragma profiles shared by the social app, the diary and the students script.
+
+Pragmas are applied to every new SQLite connection, picked by name with the
+SQLITE_PROFILE environment variable. 'performance' lets readers keep going
+while someone writes (WAL), only fsyncs at checkpoints, and keeps more of
+the database in memory. No imports beyond os, so the standalone scripts can
+use it without pulling in the web app.
+"""
+import os
+
+PRAGMA_PROFILES = {
+    'default': {},
+    'performance': {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'mmap_size': 256 * 1024 * 1024, # bytes
+        'cache_size': -64 * 1024, # negative means KiB instead of pages
+        'temp_store': 'memory',
+        'busy_timeout': 5000, # ms to wait on a locked database before erroring
+    },
+}
+SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE', 'default')
@@ -12,3 +12,16 @@ for (var num in nav) {
     }
 }
 disTime(0);
+
+// New posts arrive over Server-Sent Events while the first page of a stream is open
+var stream = document.querySelector('.stream[data-events]');
+if (stream && window.EventSource) {
+    var since = stream.getAttribute('data-since');
+    var events = new EventSource(stream.getAttribute('data-events') + (since ? '?since_id=' + since : ''));
+    events.addEventListener('post', function (event) {
+        stream.insertAdjacentHTML('afterbegin', event.data);
+    });
+    events.addEventListener('reload', function () {
+        window.location.reload(); // missed too many posts to add them one by one
+    });
+}
@@ -1,7 +1,9 @@
 from enum import unique
 from peewee import *
 
-db = SqliteDatabase('students.db')
+from sqlite_profiles import PRAGMA_PROFILES, SQLITE_PROFILE
+
+db = SqliteDatabase('students.db', pragmas=PRAGMA_PROFILES[SQLITE_PROFILE])
 
 class Student(Model): # represents a single item in a database theoretically
     username = CharField(max_length=255, unique=True) # if username is not provided, produces error b/c no default 
@@ -10,6 +12,9 @@ class Student(Model): # represents a single item in a database theoretically
     class Meta: # tell model what database it belongs to
         database = db
 
+Student.add_index(Student.index(Student.points.desc(), Student.username, name='student_points_username')) # the leaderboard, highest points first
+
+CHANGES = 0 # bumped whenever a sync changes anything, so leaderboard.py knows its cache is stale
 
 students = [
     {'username': 'khaledadad',
@@ -24,14 +29,45 @@ students = [
     'points': 14717},
 ]
 
+SYNC_BATCH_SIZE = 400 # rows per statement; 2 values a row stays under SQLite's old 999 variable limit
+
+def sync_students(rows, batch_size=SYNC_BATCH_SIZE):
+    """Insert or update students from dicts with 'username' and 'points', all in one transaction.
+
+    Each batch looks up the points we already have in one query, skips rows
+    that haven't changed, and upserts the rest with one
+    INSERT ... ON CONFLICT(username) DO UPDATE. Returns how many rows were
+    inserted, updated and unchanged.
+    """
+    global CHANGES
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    with db.atomic(): # one commit for the whole sync instead of one per student
+        for batch in chunked(rows, batch_size):
+            points = {row['username']: row['points'] for row in batch} # if a name shows up twice, the last one wins
+            current = dict(Student
+                           .select(Student.username, Student.points)
+                           .where(Student.username.in_(list(points)))
+                           .tuples())
+            changed = []
+            for username, new_points in points.items():
+                if username not in current:
+                    counts['inserted'] += 1
+                elif current[username] != new_points:
+                    counts['updated'] += 1
+                else:
+                    counts['unchanged'] += 1
+                    continue
+                changed.append((username, new_points))
+            if changed:
+                CHANGES += 1
+                (Student
+                 .insert_many(changed, fields=[Student.username, Student.points])
+                 .on_conflict(conflict_target=[Student.username], preserve=[Student.points]) # if the record already exists, update the points
+                 .execute())
+    return counts
+
 def add_students():
-    for student in students:
-        try:
-            Student.create(username=student['username'], points=student['points'])
-        except IntegrityError:
-            student_record = Student.get(username=student['username'])
-            student_record.points = student['points'] # if the record already exists, update the points
-            student_record.save()
+    return sync_students(students)
 
 def top_student():
     student = Student.select().order_by(Student.points.desc()).get() # .get() only grabs the first record to come back         
@@ -40,5 +76,6 @@ def top_student():
 if __name__ == '__main__': # if file is run directly and not imported
     db.connect() # connect to database
     db.create_tables([Student], safe=True) # if ran multiple times
-    add_students()
+    counts = add_students()
+    print('Students synced: {inserted} added, {updated} updated, {unchanged} unchanged.'.format(**counts))
     print(f'Our top student right now is: {top_student()}')
\ No newline at end of file
@@ -0,0 +1,61 @@
+"""Shared fixtures: every test gets its own throwaway social.db in a temp directory."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the app's modules live at the top level
+os.environ.setdefault('BCRYPT_ROUNDS', '4') # the lowest bcrypt allows; tests don't need slow hashes
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """models.DATABASE pointed at an empty, initialized database, with every cache emptied."""
+    monkeypatch.chdir(tmp_path) # graph snapshots, fragments.db and friends land here too
+    import fragments
+    import graph
+    import models
+
+    models.DATABASE.close_all() # pooled connections to the last test's database
+    models.DATABASE.init(str(tmp_path / 'social.db'))
+    models.initialize()
+    monkeypatch.setattr(models, 'USER_CACHE', models.UserCache())
+    monkeypatch.setattr(models, 'UNIQUENESS_CACHE', models.UniquenessCache())
+    monkeypatch.setattr(fragments, 'cache', fragments.FragmentCache(fragments.MemoryStore()))
+    monkeypatch.setattr(graph, '_graph', None)
+    monkeypatch.setattr(graph, '_changes', graph.deque()) # follows from earlier tests aren't replayed
+    yield models.DATABASE
+    models.DATABASE.close_all()
+
+
+@pytest.fixture
+def app(db):
+    from app import app
+
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    return app
+
+
+@pytest.fixture
+def make_user(db):
+    """make_user('name') creates a user whose password is 'password', without going through the password pool."""
+    from flask_bcrypt import generate_password_hash
+    import models
+
+    password = generate_password_hash('password', 4)
+    def make_user(username):
+        return models.User.create(username=username, email=f'{username}@example.com', password=password)
+    return make_user
+
+
+@pytest.fixture
+def login(app):
+    """login(user) is a test client with `user` logged in."""
+    def login(user=None):
+        client = app.test_client()
+        if user is not None:
+            with client.session_transaction() as session:
+                session['_user_id'] = str(user.id)
+                session['_fresh'] = True
+        return client
+    return login
@@ -0,0 +1,101 @@
+import asyncio
+import time
+
+import pytest
+
+import live
+import models
+
+
+@pytest.fixture
+def asgi(app, monkeypatch):
+    monkeypatch.setattr(models, 'OFFLOAD_QUERIES', models.OFFLOAD_QUERIES) # importing asgi turns it on; put it back afterwards
+    import asgi
+    models.OFFLOAD_QUERIES = True
+    return asgi
+
+
+def call(application, method, path, body=b'', headers=(), query=b''):
+    """Send one request through the ASGI app and return (status, headers, body)."""
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query, 'http_version': '1.1',
+             'headers': [(name.encode(), value.encode()) for name, value in headers],
+             'server': ('testserver', 80), 'client': ('127.0.0.1', 5000)}
+    incoming = [{'type': 'http.request', 'body': body[:3], 'more_body': True},
+                {'type': 'http.request', 'body': body[3:]}] # the body in two parts
+    sent = []
+
+    async def receive():
+        if incoming:
+            return incoming.pop(0)
+        await asyncio.Event().wait() # the client stays connected until the app has answered
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(application(scope, receive, send))
+    start, *bodies = sent
+    assert start['type'] == 'http.response.start' and not bodies[-1].get('more_body')
+    return start['status'], dict(start['headers']), b''.join(message.get('body', b'') for message in bodies)
+
+
+def test_pages_through_asgi(asgi, make_user):
+    user = make_user('someone')
+    post = models.Post.create(user=user, content='hello over asgi')
+    status, headers, body = call(asgi.application, 'GET', f'/post/{post.id}')
+    assert status == 200 and b'hello over asgi' in body
+    assert headers[b'content-type'].startswith(b'text/html')
+    assert call(asgi.application, 'GET', '/', query=b'after=garbage')[0] == 404
+
+
+def test_form_posts_through_asgi(asgi, make_user):
+    make_user('someone')
+    form = b'email=someone%40example.com&password=wrong'
+    status, headers, body = call(asgi.application, 'POST', '/login', form,
+                                 headers=[('Content-Type', 'application/x-www-form-urlencoded'),
+                                          ('Content-Length', str(len(form)))])
+    assert status == 200 and b'match' in body # the form saw the whole body
+
+
+def test_lifespan(asgi):
+    messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    asyncio.run(asgi.application({'type': 'lifespan'}, receive, send))
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+
+
+def test_disconnect_ends_an_event_stream(asgi, monkeypatch):
+    monkeypatch.setattr(live, 'KEEPALIVE', 0.05)
+    scope = {'type': 'http', 'method': 'GET', 'path': '/events', 'query_string': b'', 'http_version': '1.1',
+             'headers': [], 'server': ('testserver', 80), 'client': ('127.0.0.1', 5000)}
+    sent = []
+
+    async def run():
+        gone = asyncio.Event()
+        incoming = [{'type': 'http.request'}]
+
+        async def receive():
+            if incoming:
+                return incoming.pop(0)
+            await gone.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message): # like uvicorn, sending to a closed connection doesn't raise
+            sent.append(message)
+            if message.get('body'):
+                gone.set() # the client goes away after the first event
+                assert len(live.hub) == 1
+
+        await asyncio.wait_for(asgi.application(scope, receive, send), timeout=5)
+
+    started = time.monotonic()
+    asyncio.run(run())
+    assert time.monotonic() - started < 2 # not STREAM_MAX_AGE
+    assert len(live.hub) == 0 # the stream's subscription went with it
+    assert [message.get('body', b'')[:6] for message in sent[1:]] == [b'retry:']
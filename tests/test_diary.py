@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+import diary
+
+BROWSE_ENTRIES = int(os.environ.get('DIARY_BROWSE_ENTRIES', 200000)) # DIARY_BROWSE_ENTRIES=1000000 for the full run
+RSS_BUDGET_KB = 16 * 1024 # how much browsing may add to the process's peak RSS
+
+# Runs in a fresh interpreter, so the peak RSS it reports is only its own
+BROWSE = '''
+import resource, sys
+import diary
+diary.db.init(sys.argv[1])
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+count = sum(1 for entry in diary.iter_entries())
+print(count, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+'''
+
+
+@pytest.fixture
+def diary_db(tmp_path):
+    path = str(tmp_path / 'diary.db')
+    diary.db.init(path)
+    diary.db.create_tables([diary.Entry])
+    yield path
+    diary.db.close()
+
+
+def add_entries(path, count, start=datetime(2000, 1, 1)):
+    with sqlite3.connect(path) as connection: # no peewee: a million model instances would take longer than the test
+        connection.executemany('INSERT INTO entry (content, timestamp) VALUES (?, ?)', (
+            (f'entry {number}', str(start + timedelta(minutes=number))) for number in range(count)))
+
+
+def test_browsing_keeps_memory_flat(diary_db):
+    add_entries(diary_db, BROWSE_ENTRIES)
+    result = subprocess.run([sys.executable, '-c', BROWSE, diary_db], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(diary.__file__)))
+    count, grew_kb = map(int, result.stdout.split())
+    assert count == BROWSE_ENTRIES
+    assert grew_kb < RSS_BUDGET_KB, f'browsing {count} entries grew RSS by {grew_kb} KiB'
+
+
+def test_browsing_pages_in_order_and_jumps_by_date(diary_db):
+    add_entries(diary_db, 120)
+    entries = list(diary.iter_entries(batch_size=7))
+    assert [entry.content for entry in entries] == [f'entry {number}' for number in reversed(range(120))]
+    jumped = list(diary.iter_entries(before=datetime(2000, 1, 1, 1, 0), batch_size=7)) # entries 0-59 are before 01:00
+    assert [entry.content for entry in jumped] == [f'entry {number}' for number in reversed(range(60))]
+
+
+def test_scripts_do_not_import_the_web_app():
+    check = 'import sys, diary, students; print(sorted({"flask", "models", "app"} & set(sys.modules)))'
+    result = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(diary.__file__)))
+    assert result.stdout.strip() == '[]'
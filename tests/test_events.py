@@ -0,0 +1,61 @@
+import threading
+
+import models
+
+
+def open_streams(login, user, urls):
+    """Open each /events url on its own thread, as a server would, and wait for the first chunk of each.
+
+    Returns a function that closes them all again.
+    """
+    opened, done = threading.Barrier(len(urls) + 1), threading.Event()
+    errors = []
+
+    def listen(url):
+        try:
+            response = login(user).get(url, buffered=False)
+            assert response.status_code == 200
+            next(iter(response.response)) # the retry: line
+        except Exception as error:
+            errors.append(error)
+            opened.abort()
+            raise
+        opened.wait()
+        done.wait()
+        response.close() # ends the generator, as a browser going away would
+
+    threads = [threading.Thread(target=listen, args=(url,)) for url in urls]
+    for thread in threads:
+        thread.start()
+    opened.wait(timeout=10)
+    assert not errors
+
+    def close():
+        done.set()
+        for thread in threads:
+            thread.join()
+    return close
+
+
+def test_open_streams_hold_no_connections(login, make_user):
+    user, other = make_user('reader'), make_user('writer')
+    models.Relationship.create(from_user=user, to_user=other)
+    models.DATABASE.close() # this thread's setup connection
+    urls = ['/events', '/events/stream', '/events/stream/writer', '/events/stream?since_id=0'] * 2
+    close = open_streams(login, user, urls)
+    try:
+        assert len(models.DATABASE._in_use) == 0
+    finally:
+        close()
+
+
+def test_stream_catches_up_from_since_id(login, make_user):
+    user = make_user('reader')
+    first = models.Post.create(user=user, content='first')
+    second = models.Post.create(user=user, content='second')
+    response = login(user).get(f'/events/stream/reader?since_id={first.id}', buffered=False)
+    chunks = iter(response.response)
+    next(chunks) # retry:
+    event = next(chunks).decode()
+    response.close()
+    assert f'id: {second.id}' in event and 'second' in event
@@ -0,0 +1,23 @@
+import fragments
+
+
+def test_memory_store_counts_bytes_not_characters():
+    store = fragments.MemoryStore(max_bytes=100)
+    store.set('a', 'é' * 30, 60) # 30 characters, 60 bytes
+    assert store.size == 61
+    store.set('b', 'é' * 30, 60)
+    assert store.get('a') is None # 122 bytes is over the cap, so the oldest went
+    assert store.get('b') == 'é' * 30
+
+
+def test_index_is_not_cached_in_debug_mode(app, make_user, monkeypatch):
+    make_user('author')
+    client = app.test_client()
+    assert client.get('/').status_code == 200
+    assert fragments.cache.stats()['page']['misses'] == 1
+
+    monkeypatch.setitem(app.config, 'DEBUG', True)
+    response = client.get('/')
+    assert b'debug-queries' in response.data # this request's own panel
+    client.get('/')
+    assert fragments.cache.stats()['page'] == {'hits': 0, 'misses': 1, 'hit_rate': 0} # the cache wasn't asked
@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+
+import graph
+import models
+
+
+def test_graph_imports_without_models():
+    check = 'import sys, graph; print("models" in sys.modules)'
+    result = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(graph.__file__)))
+    assert result.stdout.strip() == 'False'
+
+
+def test_follows_after_the_snapshot_survive_a_reload(db, make_user, monkeypatch):
+    ann, bob, cat = make_user('ann'), make_user('bob'), make_user('cat')
+    models.Relationship.create(from_user=ann, to_user=bob)
+    assert list(graph.get_graph().following(ann.id)) == [bob.id] # loaded from the database and saved as the snapshot
+
+    models.Relationship.create(from_user=ann, to_user=cat)
+    models.Relationship.get(from_user=ann, to_user=bob).delete_instance()
+    monkeypatch.setattr(graph.Graph, 'is_stale', lambda self: True) # reload, mapping the snapshot from before those
+    reloaded = graph.get_graph()
+    assert list(reloaded.following(ann.id)) == [cat.id]
+    assert list(reloaded.followers(bob.id)) == []
+
+    models.Relationship.create(from_user=ann, to_user=bob) # replayed and repeated changes still add up
+    models.Relationship.get(from_user=ann, to_user=cat).delete_instance()
+    assert list(graph.get_graph().following(ann.id)) == [bob.id]
+    assert graph.get_graph().mutuals(bob.id) == []
@@ -0,0 +1,33 @@
+import pytest
+
+import leaderboard
+import students
+from students import Student
+
+
+@pytest.fixture
+def board_db(tmp_path, monkeypatch):
+    students.db.init(str(tmp_path / 'students.db'))
+    leaderboard.initialize()
+    monkeypatch.setattr(leaderboard, '_board', None)
+    students.sync_students([{'username': name, 'points': points}
+                            for name, points in [('ann', 300), ('bob', 200), ('cat', 200), ('dan', 100)]])
+    yield
+    students.db.close()
+
+
+def test_ranks_share_ties(board_db):
+    assert leaderboard.top(4) == [(1, 'ann', 300), (2, 'bob', 200), (2, 'cat', 200), (4, 'dan', 100)]
+    assert leaderboard.rank('cat') == 2
+    assert leaderboard.rank('nobody') is None
+    assert leaderboard.around('dan', radius=1) == [(2, 'cat', 200), (4, 'dan', 100)]
+
+
+def test_points_changed_by_another_process(board_db):
+    board = leaderboard.get_board()
+    Student.update(points=400).where(Student.username == 'dan').execute() # no CHANGES bump, like a sync elsewhere
+    Student.create(username='eve', points=250)
+    assert leaderboard.rank('dan') == 1
+    assert leaderboard.around('eve', radius=1) == [(2, 'ann', 300), (3, 'eve', 250), (4, 'bob', 200)]
+    assert leaderboard.get_board() is not board
+    assert leaderboard.rank('dan') == leaderboard.rank_in_db('dan')
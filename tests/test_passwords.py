@@ -0,0 +1,33 @@
+import threading
+
+import models
+import passwords
+
+
+def register(client, username):
+    return client.post('/register', data={'username': username, 'email': f'{username}@example.com',
+                                          'password': 'secret', 'password2': 'secret'})
+
+
+def test_register_then_log_in_through_the_pool(login):
+    client = login()
+    assert register(client, 'newcomer').status_code == 302
+    user = models.User.get(models.User.username == 'newcomer')
+    assert passwords.check_password(user.password, 'secret')
+    assert passwords._get_executor()._mp_context.get_start_method() == passwords.START_METHOD != 'fork'
+
+    response = client.post('/login', data={'email': 'newcomer@example.com', 'password': 'secret'})
+    assert response.status_code == 302
+    response = client.post('/login', data={'email': 'newcomer@example.com', 'password': 'wrong'})
+    assert response.status_code == 200 and b'match' in response.data
+
+
+def test_a_full_pool_answers_503(login, make_user, monkeypatch):
+    make_user('someone')
+    monkeypatch.setattr(passwords, '_slots', threading.BoundedSemaphore(1))
+    passwords._slots.acquire() # every slot taken
+    response = login().post('/login', data={'email': 'someone@example.com', 'password': 'x'})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '5'
+    assert register(login(), 'latecomer').status_code == 503
+    assert not models.User.select().where(models.User.username == 'latecomer').exists()
@@ -0,0 +1,72 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import instrumentation
+import models
+
+
+def follow_authors(reader, make_user, first, last, posts_each):
+    """Have `reader` follow author<first>..author<last - 1>, each with `posts_each` posts."""
+    for number in range(first, last):
+        author = make_user(f'author{number}')
+        models.Relationship.create(from_user=reader, to_user=author)
+        models.Post.insert_many([(author.id, f'post {post}') for post in range(posts_each)],
+                                fields=[models.Post.user, models.Post.content]).execute()
+    models.rebuild_stats() # insert_many skips the counters
+
+
+@pytest.mark.parametrize('offload', [False, True]) # as under a WSGI server, and as under asgi.py
+@pytest.mark.parametrize('url', ['/', '/stream', '/stream/author0', '/stream/reader', '/post/1'])
+def test_query_count_does_not_grow_with_the_page(login, make_user, monkeypatch, url, offload):
+    monkeypatch.setattr(models, 'OFFLOAD_QUERIES', offload)
+    reader = make_user('reader')
+    follow_authors(reader, make_user, 0, 1, posts_each=1)
+    client = login(reader)
+    client.get(url) # the first request of a session also fills the user cache
+    with instrumentation.max_queries(1000) as one_author:
+        assert client.get(url).status_code == 200
+
+    follow_authors(reader, make_user, 1, 50, posts_each=3) # 50 authors now, and over a page of posts
+    with instrumentation.max_queries(one_author.count): # fails with the count if it went up
+        response = client.get(url)
+    assert response.status_code == 200
+    if url in ('/', '/stream'):
+        assert response.data.count(b'<article') == models.PAGE_SIZE
+
+
+@pytest.mark.parametrize('strategy', ['read', 'fanout'])
+def test_stream_pages_walk_every_post_once(db, make_user, monkeypatch, strategy):
+    monkeypatch.setattr(models, 'TIMELINE_STRATEGY', strategy)
+    reader, stranger = make_user('reader'), make_user('stranger')
+    authors = [make_user(f'author{number}') for number in range(3)]
+    for author in authors:
+        models.Relationship.create(from_user=reader, to_user=author)
+    for number in range(40):
+        models.Post.create(user=([reader, stranger] + authors)[number % 5], content=f'post {number}')
+    expected = [post.id for post in models.Post.select().where(models.Post.user != stranger)
+                .order_by(models.Post.timestamp.desc(), models.Post.id.desc())]
+
+    seen, older = [], None
+    while True: # back through the stream 7 posts at a time
+        posts, older, newer = models.paginate(reader.get_stream(), after=older, per_page=7)
+        seen += [post.id for post in posts]
+        if not older:
+            break
+    assert seen == expected
+
+    posts, _, _ = models.paginate(reader.get_stream(), before=models.encode_cursor(posts[-1]), per_page=7)
+    assert [post.id for post in posts] == expected[-8:-1] # and forward again from the oldest
+
+
+@pytest.mark.parametrize('strategy, ok', [('fanout', True), ('fan-out', False)])
+def test_timeline_strategy_comes_from_the_environment(strategy, ok):
+    result = subprocess.run([sys.executable, '-c', 'import models; print(models.TIMELINE_STRATEGY)'],
+                            capture_output=True, text=True, env={**os.environ, 'TIMELINE_STRATEGY': strategy},
+                            cwd=os.path.dirname(os.path.abspath(models.__file__)))
+    if ok:
+        assert result.stdout.strip() == strategy
+    else:
+        assert 'TIMELINE_STRATEGY must be one of read, fanout' in result.stderr
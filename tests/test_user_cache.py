@@ -0,0 +1,34 @@
+import threading
+
+import models
+
+
+def test_invalidate_during_a_read_keeps_the_old_row_out(db, make_user, monkeypatch):
+    user = make_user('before')
+    cache = models.USER_CACHE
+    get_by_id = models.User.get_by_id
+
+    def slow_read(user_id):
+        row = get_by_id(user_id) # the old row...
+        models.User.update(username='after').where(models.User.id == user_id).execute()
+        cache.invalidate(user_id) # ...is invalidated before the cache gets to store it
+        return row
+
+    monkeypatch.setattr(models.User, 'get_by_id', slow_read)
+    assert cache.get(user.id).username == 'before'
+    monkeypatch.setattr(models.User, 'get_by_id', get_by_id)
+    assert cache.get(user.id).username == 'after'
+
+
+def test_rows_read_before_a_save_commits_are_dropped(db, make_user):
+    user = make_user('before')
+    cache = models.USER_CACHE
+    seen = []
+    with models.DATABASE.atomic():
+        user.username = 'after'
+        user.save()
+        reader = threading.Thread(target=lambda: seen.append(cache.get(user.id).username)) # another request
+        reader.start()
+        reader.join()
+    assert seen == ['before'] # it couldn't see the uncommitted row, and cached the old one
+    assert cache.get(user.id).username == 'after'
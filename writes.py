@@ -0,0 +1,128 @@
+"""Group commit: one background thread does all the app's writes, many per transaction.
+
+SQLite only lets one connection write at a time, so request threads that each
+commit their own insert queue up on the lock (and eventually get "database is
+locked"). Instead requests hand their write to the writer thread and wait for
+the result; the writer runs everything that has queued up in one transaction.
+"""
+import asyncio
+from concurrent.futures import Future, TimeoutError
+import os
+import queue
+import threading
+import time
+
+import models
+
+WRITE_MODE = os.environ.get('WRITE_MODE', 'direct') # 'queue' sends writes through the writer thread
+WRITE_BATCH_SIZE = 64 # most operations committed together
+WRITE_BATCH_WAIT = 0.005 # seconds the writer waits for more operations to join a batch
+WRITE_QUEUE_LIMIT = 1024 # operations waiting before we start turning requests away
+WRITE_TIMEOUT = 10 # seconds a request waits for its write
+
+class QueueFull(Exception):
+    """Too many writes are already waiting; the caller should answer 503."""
+
+class WriteQueue:
+    def __init__(self, database, batch_size=WRITE_BATCH_SIZE, batch_wait=WRITE_BATCH_WAIT,
+                 limit=WRITE_QUEUE_LIMIT):
+        self.database = database
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._queue = queue.Queue(maxsize=limit)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0 # how many transactions the writer has committed
+        self.operations = 0 # and how many operations went into them
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) for the writer; returns a Future for its result."""
+        self._start()
+        future = Future()
+        try:
+            self._queue.put_nowait((future, func, args, kwargs))
+        except queue.Full:
+            raise QueueFull()
+        return future
+
+    def _start(self):
+        with self._lock: # only the first write starts the thread
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        self.database.connect(reuse_if_open=True) # the writer keeps one pooled connection for good
+        while True:
+            batch = [self._queue.get()] # sleep until there is something to write
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=max(remaining, 0)))
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        """Run a batch in one transaction, then hand each request its own result or error."""
+        outcomes = []
+        try:
+            if self.database.is_closed(): # e.g. a failed commit closed it
+                self.database.connect()
+            with self.database.atomic():
+                for future, func, args, kwargs in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        with self.database.atomic(): # a savepoint, so one failed operation doesn't sink the rest
+                            outcomes.append((future, func(*args, **kwargs), None))
+                    except Exception as error:
+                        outcomes.append((future, None, error))
+        except Exception as error: # the commit itself failed, so nothing in the batch was saved
+            for future, *_ in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        self.batches += 1
+        self.operations += len(outcomes)
+        for future, result, error in outcomes: # only tell anyone after the commit has succeeded
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = WriteQueue(models.DATABASE)
+        return _writer
+
+def perform(func, *args, **kwargs):
+    """Do a write and return its result, raising whatever it raised.
+
+    With WRITE_MODE = 'queue' the writer thread does it as part of a batch,
+    otherwise it just runs here.
+    """
+    if WRITE_MODE != 'queue':
+        return func(*args, **kwargs)
+    if not models.DATABASE.in_transaction():
+        models.DATABASE.close() # give our pooled connection back while we wait, or the writer could be left without one
+    try:
+        return get_writer().submit(func, *args, **kwargs).result(timeout=WRITE_TIMEOUT)
+    except TimeoutError:
+        raise QueueFull()
+
+async def aperform(func, *args, **kwargs):
+    """perform() for async views: awaits the writer, or a database thread, instead of blocking."""
+    if WRITE_MODE != 'queue':
+        return await models.run_in_db(func, *args, **kwargs)
+    try:
+        future = get_writer().submit(func, *args, **kwargs)
+        return await asyncio.wait_for(asyncio.wrap_future(future), WRITE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise QueueFull()